@@ -1,6 +1,6 @@
 # app.py
 from flask import Flask, redirect, url_for, request, render_template
-from flask_login import LoginManager
+from flask_login import LoginManager, current_user
 from flask_migrate import Migrate
 from flask_talisman import Talisman
 from flask_limiter import Limiter
@@ -21,7 +21,7 @@ import traceback
 # カレントディレクトリをパスに追加
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-from models import db, User, OperationLog
+from models import db, User, OperationLog, init_password_hasher
 
 # Flask-Mail instance for email services
 mail = Mail()
@@ -32,7 +32,13 @@ from routes.admin import admin_bp
 from routes.reservations import reservations_bp
 from routes.api import api_bp
 from routes.home import home_bp
+from routes.jobs import jobs_bp
 from utils.logger import setup_logger
+from utils.sql_profiler import init_sql_profiler
+from services.outbox_service import init_outbox_dispatcher
+from services.email_service import init_email_templates
+from services.job_service import init_job_worker
+from services.suggest_service import init_suggest_index
 from config import config
 
 @click.command('init-db')
@@ -101,6 +107,71 @@ def reset_admin_password_command():
         db.session.rollback()
         print(f"Error resetting admin password for {admin_email}: {e}")
 
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """書籍検索用のポスティングリストを全件作り直します。"""
+    from services.search_service import rebuild_search_index
+    count = rebuild_search_index()
+    print(f'Rebuilt the search index for {count} books.')
+
+@click.command('refresh-popular-books')
+@with_appcontext
+def refresh_popular_books_command():
+    """人気の本のランキングを貸出履歴から集計し直します。"""
+    from services.popularity_service import refresh_book_popularity
+    count = refresh_book_popularity()
+    print(f'Refreshed the popularity ranking for {count} books.')
+
+@click.command('reconcile-user-counters')
+@with_appcontext
+def reconcile_user_counters_command():
+    """ユーザーごとの貸出・予約・延滞の件数を集計し直します。"""
+    from services.user_service import reconcile_user_counters
+    count = reconcile_user_counters()
+    print(f'Reconciled loan counters for {count} users.')
+
+@click.command('sync-slack-users')
+@with_appcontext
+def sync_slack_users_command():
+    """Slackのユーザー一覧を取り込み、ユーザーのSlack IDをまとめて更新します。"""
+    from services.slack_service import sync_slack_user_ids
+    result = sync_slack_user_ids()
+    if result is None:
+        print('Failed to fetch the Slack user list. See the log for details.')
+        return
+    print(f'Synced {result[0]} Slack users and updated {result[1]} library users.')
+
+@click.command('dispatch-notifications')
+@click.option('--loop', is_flag=True, help='送信待ちの通知を監視し続けます。')
+@with_appcontext
+def dispatch_notifications_command(loop):
+    """送信待ちの通知（アウトボックス）を送信します。"""
+    import time
+    from flask import current_app
+    from services.outbox_service import dispatch_pending_notifications
+    batch_size = current_app.config.get('OUTBOX_BATCH_SIZE', 50)
+    while True:
+        count = dispatch_pending_notifications(batch_size)
+        if not loop:
+            print(f'Dispatched {count} notifications.')
+            break
+        if count < batch_size:
+            time.sleep(current_app.config.get('OUTBOX_POLL_INTERVAL', 5))
+
+@click.command('run-jobs')
+@click.option('--once', is_flag=True, help='実行待ちのジョブを処理したら終了します。')
+@with_appcontext
+def run_jobs_command(once):
+    """CSVインポートなどのバックグラウンドジョブを実行します。"""
+    from flask import current_app
+    from services.job_service import run_pending_jobs, run_worker
+    if once:
+        count = run_pending_jobs()
+        print(f'Ran {count} jobs.')
+        return
+    run_worker(current_app._get_current_object())
+
 def create_admin(app):
     with app.app_context():
         # 初期管理者ユーザーの作成
@@ -232,6 +303,8 @@ def create_app(config_name=None):
     
     # データベース初期化
     db.init_app(app)
+    init_sql_profiler(app)
+    init_password_hasher(app)
     Bootstrap(app)
     migrate = Migrate(app, db)
     
@@ -270,10 +343,29 @@ def create_app(config_name=None):
     app.register_blueprint(admin_bp, url_prefix='/admin')
     app.register_blueprint(reservations_bp, url_prefix='/reservations')
     app.register_blueprint(api_bp, url_prefix='/api')
+    app.register_blueprint(jobs_bp, url_prefix='/jobs')
 
     # カスタムCLIコマンドの登録
     app.cli.add_command(init_db_command)
     app.cli.add_command(reset_admin_password_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(refresh_popular_books_command)
+    app.cli.add_command(reconcile_user_counters_command)
+    app.cli.add_command(sync_slack_users_command)
+    app.cli.add_command(dispatch_notifications_command)
+    app.cli.add_command(run_jobs_command)
+    
+    # 通知アウトボックスのディスパッチャー
+    init_outbox_dispatcher(app)
+    
+    # メールテンプレートの読み込み
+    init_email_templates(app)
+    
+    # バックグラウンドジョブのワーカー（JOB_WORKER_ENABLED の場合のみプロセス内で起動）
+    init_job_worker(app)
+    
+    # 入力補完のインデックス（リクエストを処理するプロセスでのみバックグラウンドで作成する）
+    init_suggest_index(app)
 
     # レート制限の設定
     limiter = Limiter(
@@ -281,6 +373,13 @@ def create_app(config_name=None):
         key_func=get_remote_address,
         default_limits=["200 per day", "50 per hour"]
     )
+    # ジョブの進捗画面は処理が終わるまでポーリングするため制限しない
+    limiter.exempt(jobs_bp)
+    # 入力補完はキー入力ごとに呼ばれるため、既定の制限ではなくユーザー単位の短い間隔の制限にする
+    app.view_functions['api.suggest_books'] = limiter.limit(
+        app.config['SUGGEST_RATE_LIMIT'],
+        key_func=lambda: f'user:{current_user.id}' if current_user.is_authenticated else get_remote_address()
+    )(app.view_functions['api.suggest_books'])
     
     
     @app.errorhandler(404)
@@ -30,12 +30,52 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or 'noreply@library.local'
+    # 送信ワーカー数・送信待ちキューの上限・1回のSMTP接続で送る件数
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_ENQUEUE_TIMEOUT = float(os.environ.get('MAIL_ENQUEUE_TIMEOUT') or 1)
     
     # Slack連携
     SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
     SLACK_ENABLED = os.environ.get('SLACK_ENABLED', 'false').lower() in ['true', '1', 't']
     ADMIN_SLACK_EMAIL = os.environ.get('ADMIN_SLACK_EMAIL', 'Development@xcap.co.jp')
     
+    # 通知アウトボックス（false の場合は `flask dispatch-notifications --loop` を別プロセスで起動する）
+    OUTBOX_DISPATCHER_ENABLED = os.environ.get('OUTBOX_DISPATCHER_ENABLED', 'false').lower() in ['true', '1', 't']
+    OUTBOX_POLL_INTERVAL = int(os.environ.get('OUTBOX_POLL_INTERVAL') or 5)
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE') or 50)
+    
+    # バックグラウンドジョブ（false の場合は `flask run-jobs` を別プロセスで起動する）
+    JOB_WORKER_ENABLED = os.environ.get('JOB_WORKER_ENABLED', 'false').lower() in ['true', '1', 't']
+    JOB_POLL_INTERVAL = int(os.environ.get('JOB_POLL_INTERVAL') or 5)
+    
+    # 書籍検索（関連度順で表示する最大件数）
+    SEARCH_RESULT_LIMIT = int(os.environ.get('SEARCH_RESULT_LIMIT') or 100)
+    
+    # 入力補完APIのレート制限（ユーザー単位。キー入力ごとに呼ばれるため既定の制限は適用しない）
+    SUGGEST_RATE_LIMIT = os.environ.get('SUGGEST_RATE_LIMIT') or '10 per second;300 per minute'
+    
+    # 書籍一覧の1ページあたりの件数
+    BOOKS_PER_PAGE = int(os.environ.get('BOOKS_PER_PAGE') or 50)
+    
+    # 人気の本の集計期間と時間減衰の半減期（日数、0で減衰なし）
+    POPULAR_BOOKS_WINDOW_DAYS = int(os.environ.get('POPULAR_BOOKS_WINDOW_DAYS') or 30)
+    POPULAR_BOOKS_HALF_LIFE_DAYS = float(os.environ.get('POPULAR_BOOKS_HALF_LIFE_DAYS') or 7)
+    
+    # SQLプロファイラー（リクエストごとのSQL件数・時間をレスポンスヘッダーに出力）
+    SQL_PROFILER_ENABLED = os.environ.get('SQL_PROFILER_ENABLED', 'false').lower() in ['true', '1', 't']
+    SQL_PROFILER_PANEL = os.environ.get('SQL_PROFILER_PANEL', 'false').lower() in ['true', '1', 't']
+    SQL_PROFILER_SLOWEST = int(os.environ.get('SQL_PROFILER_SLOWEST') or 5)
+    
+    # パスワードハッシュ（Argon2）のパラメータ。変更すると既存ユーザーは次回ログイン時にハッシュし直される
+    ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST') or 3)
+    ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST') or 65536)  # KiB
+    ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM') or 4)
+    # 1プロセスで同時に実行するパスワード照合の上限と、空きを待つ秒数
+    PASSWORD_VERIFY_CONCURRENCY = int(os.environ.get('PASSWORD_VERIFY_CONCURRENCY') or 4)
+    PASSWORD_VERIFY_TIMEOUT = float(os.environ.get('PASSWORD_VERIFY_TIMEOUT') or 5)
+    
     # 管理者パスワード
     ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'adminpass')
     
@@ -57,6 +97,7 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'mysql+pymysql://root:password@db/library_test'
     WTF_CSRF_ENABLED = False
+    OUTBOX_DISPATCHER_ENABLED = False
 
 class ProductionConfig(Config):
     """本番環境設定"""
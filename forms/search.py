@@ -2,8 +2,11 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, SelectField
 from wtforms.validators import Optional
 from forms.book import CATEGORIES
+from models import BookStatus
 
 class SearchForm(FlaskForm):
     keyword = StringField('キーワード', validators=[Optional()])
     category1 = SelectField('第１分類', choices=[('', '選択してください')] + [(cat, cat) for cat in CATEGORIES.keys()], validators=[Optional()])
-    category2 = SelectField('第２分類', choices=[('', '選択してください')], validators=[Optional()]) 
\ No newline at end of file
+    category2 = SelectField('第２分類', choices=[('', '選択してください')], validators=[Optional()])
+    status = SelectField('状態', choices=[('', 'すべて')] + [(s.name, s.value) for s in BookStatus], validators=[Optional()])
+    sort = SelectField('並び順', choices=[('relevance', '関連度順'), ('title', 'タイトル順')], default='relevance', validators=[Optional()])
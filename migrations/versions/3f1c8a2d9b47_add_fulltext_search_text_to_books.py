@@ -0,0 +1,54 @@
+"""Add full-text search column to books
+
+Revision ID: 3f1c8a2d9b47
+Revises: 11820ac79a33
+Create Date: 2026-10-18 09:12:41.305118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c8a2d9b47'
+down_revision = '11820ac79a33'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('books', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_text', sa.Text(), nullable=True))
+
+    # 既存書籍の検索用テキストを Book.search_vector と同じ規則で作成
+    connection = op.get_bind()
+    books = sa.table(
+        'books',
+        sa.column('id', sa.Integer),
+        sa.column('title', sa.String),
+        sa.column('author', sa.String),
+        sa.column('category1', sa.String),
+        sa.column('category2', sa.String),
+        sa.column('keywords', sa.String),
+        sa.column('search_text', sa.Text),
+    )
+    rows = connection.execute(sa.select(
+        books.c.id, books.c.title, books.c.author,
+        books.c.category1, books.c.category2, books.c.keywords
+    )).fetchall()
+    for row in rows:
+        search_text = ' '.join(filter(None, [
+            row.title, row.author, row.category1, row.category2, row.keywords
+        ])).lower()
+        connection.execute(
+            books.update().where(books.c.id == row.id).values(search_text=search_text)
+        )
+
+    op.create_index('ix_books_search_text', 'books', ['search_text'], unique=False,
+                    mysql_prefix='FULLTEXT', mysql_with_parser='ngram')
+
+
+def downgrade():
+    op.drop_index('ix_books_search_text', table_name='books')
+    with op.batch_alter_table('books', schema=None) as batch_op:
+        batch_op.drop_column('search_text')
@@ -0,0 +1,100 @@
+"""Add book search posting list
+
+Revision ID: 8b4e2f6c1a93
+Revises: 3f1c8a2d9b47
+Create Date: 2026-10-18 11:03:27.518204
+
+"""
+from collections import Counter
+
+from alembic import op
+import sqlalchemy as sa
+
+from utils.tokenizer import normalize, split_segments, tokenize
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e2f6c1a93'
+down_revision = '3f1c8a2d9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('book_search_terms',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('term', sa.String(length=16), nullable=False),
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.Column('field', sa.String(length=20), nullable=False),
+    sa.Column('term_freq', sa.Integer(), nullable=False),
+    sa.Column('field_length', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['book_id'], ['books.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('book_search_terms', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_book_search_terms_book_id'), ['book_id'], unique=False)
+        batch_op.create_index('ix_book_search_terms_term_book', ['term', 'book_id'], unique=False)
+
+    # 既存書籍の検索用テキストを検索語と同じ規則（normalize）で作り直し、
+    # ポスティングリストを services.search_service.build_term_rows と同じ規則で作成する
+    connection = op.get_bind()
+    books = sa.table(
+        'books',
+        sa.column('id', sa.Integer),
+        sa.column('title', sa.String),
+        sa.column('author', sa.String),
+        sa.column('category1', sa.String),
+        sa.column('category2', sa.String),
+        sa.column('keywords', sa.String),
+        sa.column('search_text', sa.Text),
+    )
+    terms = sa.table(
+        'book_search_terms',
+        sa.column('term', sa.String),
+        sa.column('book_id', sa.Integer),
+        sa.column('field', sa.String),
+        sa.column('term_freq', sa.Integer),
+        sa.column('field_length', sa.Integer),
+    )
+    rows = connection.execute(sa.select(
+        books.c.id, books.c.title, books.c.author,
+        books.c.category1, books.c.category2, books.c.keywords
+    )).fetchall()
+    term_rows = []
+    for row in rows:
+        search_text = normalize(' '.join(filter(None, [
+            row.title, row.author, row.category1, row.category2, row.keywords
+        ])))
+        connection.execute(
+            books.update().where(books.c.id == row.id).values(search_text=search_text)
+        )
+
+        fields = {
+            'title': row.title,
+            'author': row.author,
+            'keywords': row.keywords,
+            'category': ' '.join(filter(None, [row.category1, row.category2])),
+        }
+        for field, value in fields.items():
+            if not value:
+                continue
+            field_length = sum(len(segment) for segment in split_segments(normalize(value)))
+            term_rows.extend({
+                'term': term,
+                'book_id': row.id,
+                'field': field,
+                'term_freq': freq,
+                'field_length': field_length,
+            } for term, freq in Counter(tokenize(value)).items())
+        if len(term_rows) >= 5000:
+            connection.execute(terms.insert(), term_rows)
+            term_rows = []
+    if term_rows:
+        connection.execute(terms.insert(), term_rows)
+
+def downgrade():
+    with op.batch_alter_table('book_search_terms', schema=None) as batch_op:
+        batch_op.drop_index('ix_book_search_terms_term_book')
+        batch_op.drop_index(batch_op.f('ix_book_search_terms_book_id'))
+
+    op.drop_table('book_search_terms')
@@ -0,0 +1,36 @@
+"""Add Slack user ID cache
+
+Revision ID: b7e3f1a9c250
+Revises: a4c2e8f05b19
+Create Date: 2026-10-18 18:02:33.718204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3f1a9c250'
+down_revision = 'a4c2e8f05b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('slack_user_cache',
+    sa.Column('email', sa.String(length=120), nullable=False),
+    sa.Column('slack_user_id', sa.String(length=50), nullable=True),
+    sa.Column('fetched_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('email')
+    )
+    with op.batch_alter_table('slack_user_cache', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_slack_user_cache_fetched_at'), ['fetched_at'], unique=False)
+
+    # 初回の取り込みは `flask sync-slack-users` で行う
+
+
+def downgrade():
+    with op.batch_alter_table('slack_user_cache', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_slack_user_cache_fetched_at'))
+
+    op.drop_table('slack_user_cache')
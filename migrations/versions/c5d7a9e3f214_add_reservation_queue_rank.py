@@ -0,0 +1,41 @@
+"""Add materialized queue rank to reservations
+
+Revision ID: c5d7a9e3f214
+Revises: 8b4e2f6c1a93
+Create Date: 2026-10-18 14:22:05.310876
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d7a9e3f214'
+down_revision = '8b4e2f6c1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('reservations', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('queue_rank', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_reservations_book_status_rank', ['book_id', 'status', 'queue_rank'], unique=False)
+
+    # 既存の予約待ちに予約日時・ID順の順位を設定する
+    op.execute("""
+        UPDATE reservations
+        JOIN (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY book_id ORDER BY reservation_date, id
+            ) AS queue_rank
+            FROM reservations
+            WHERE status = 'PENDING'
+        ) ranked ON ranked.id = reservations.id
+        SET reservations.queue_rank = ranked.queue_rank
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('reservations', schema=None) as batch_op:
+        batch_op.drop_index('ix_reservations_book_status_rank')
+        batch_op.drop_column('queue_rank')
@@ -0,0 +1,38 @@
+"""Add per-year book number sequences
+
+Revision ID: c9d4a2b6e831
+Revises: b7e3f1a9c250
+Create Date: 2026-10-18 18:47:20.305617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d4a2b6e831'
+down_revision = 'b7e3f1a9c250'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('book_number_sequences',
+    sa.Column('year', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('last_number', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('year')
+    )
+
+    # 既存の管理番号（BO-yyyy-NNN）から年ごとの最大の連番を引き継ぐ
+    op.execute("""
+        INSERT INTO book_number_sequences (year, last_number)
+        SELECT CAST(SUBSTRING(book_number, 4, 4) AS UNSIGNED),
+               MAX(CAST(SUBSTRING_INDEX(book_number, '-', -1) AS UNSIGNED))
+        FROM books
+        WHERE book_number REGEXP '^BO-[0-9]{4}-[0-9]+$'
+        GROUP BY CAST(SUBSTRING(book_number, 4, 4) AS UNSIGNED)
+    """)
+
+
+def downgrade():
+    op.drop_table('book_number_sequences')
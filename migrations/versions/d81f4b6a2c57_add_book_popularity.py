@@ -0,0 +1,39 @@
+"""Add precomputed book popularity ranking
+
+Revision ID: d81f4b6a2c57
+Revises: c5d7a9e3f214
+Create Date: 2026-10-18 15:07:41.662094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f4b6a2c57'
+down_revision = 'c5d7a9e3f214'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('book_popularity',
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('loan_count', sa.Integer(), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['book_id'], ['books.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('book_id')
+    )
+    with op.batch_alter_table('book_popularity', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_book_popularity_rank'), ['rank'], unique=False)
+
+    # 初回の集計は `flask refresh-popular-books` で行う
+
+
+def downgrade():
+    with op.batch_alter_table('book_popularity', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_book_popularity_rank'))
+
+    op.drop_table('book_popularity')
@@ -0,0 +1,32 @@
+"""Add indexes for the borrow eligibility query
+
+Revision ID: e2a6c8d41f75
+Revises: d81f4b6a2c57
+Create Date: 2026-10-18 15:48:12.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a6c8d41f75'
+down_revision = 'd81f4b6a2c57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('loan_history', schema=None) as batch_op:
+        batch_op.create_index('ix_loan_history_borrower_active', ['borrower_id', 'return_date', 'due_date'], unique=False)
+
+    with op.batch_alter_table('reservations', schema=None) as batch_op:
+        batch_op.create_index('ix_reservations_user_status', ['user_id', 'status'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('reservations', schema=None) as batch_op:
+        batch_op.drop_index('ix_reservations_user_status')
+
+    with op.batch_alter_table('loan_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_loan_history_borrower_active')
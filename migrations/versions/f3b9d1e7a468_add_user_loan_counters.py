@@ -0,0 +1,49 @@
+"""Add denormalized loan and reservation counters to users
+
+Revision ID: f3b9d1e7a468
+Revises: e2a6c8d41f75
+Create Date: 2026-10-18 16:31:55.187320
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9d1e7a468'
+down_revision = 'e2a6c8d41f75'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('active_loans', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('pending_reservations', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('overdue_loans', sa.Integer(), server_default='0', nullable=False))
+
+    # 既存ユーザーの件数を集計する（以降は `flask reconcile-user-counters` でも再集計できる）
+    op.execute("""
+        UPDATE users SET
+            active_loans = (
+                SELECT COUNT(*) FROM loan_history
+                WHERE loan_history.borrower_id = users.id AND loan_history.return_date IS NULL
+            ),
+            pending_reservations = (
+                SELECT COUNT(*) FROM reservations
+                WHERE reservations.user_id = users.id AND reservations.status = 'PENDING'
+            ),
+            overdue_loans = (
+                SELECT COUNT(*) FROM loan_history
+                WHERE loan_history.borrower_id = users.id AND loan_history.return_date IS NULL
+                  AND loan_history.due_date < UTC_TIMESTAMP()
+            ),
+            updated_at = updated_at
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('overdue_loans')
+        batch_op.drop_column('pending_reservations')
+        batch_op.drop_column('active_loans')
@@ -5,12 +5,36 @@ from argon2 import PasswordHasher
 from datetime import datetime, timedelta
 from enum import Enum
 import json
-from sqlalchemy.orm import validates
-from sqlalchemy import or_, and_
+import threading
+from sqlalchemy.orm import validates, Session, attributes
+from sqlalchemy import or_, and_, event, select, update, bindparam, inspect, func
+
+from utils.tokenizer import normalize
 
 db = SQLAlchemy()
 ph = PasswordHasher()
 
+# パスワード照合（Argon2）の同時実行数の上限と、空きを待つ秒数（init_password_hasher で設定する）
+_verify_slots = threading.BoundedSemaphore(4)
+_verify_timeout = 5.0
+
+
+class PasswordVerificationBusy(Exception):
+    """パスワード照合の同時実行数が上限に達し、待ち時間内に空かなかった"""
+
+
+def init_password_hasher(app):
+    """設定に従ってArgon2のパラメータとパスワード照合の同時実行数を設定する"""
+    global ph, _verify_slots, _verify_timeout
+    ph = PasswordHasher(
+        time_cost=app.config.get('ARGON2_TIME_COST', 3),
+        memory_cost=app.config.get('ARGON2_MEMORY_COST', 65536),
+        parallelism=app.config.get('ARGON2_PARALLELISM', 4)
+    )
+    _verify_slots = threading.BoundedSemaphore(app.config.get('PASSWORD_VERIFY_CONCURRENCY', 4))
+    _verify_timeout = app.config.get('PASSWORD_VERIFY_TIMEOUT', 5.0)
+
+
 class User(db.Model, UserMixin):
     """ユーザー情報テーブル"""
     __tablename__ = 'users'
@@ -22,6 +46,10 @@ class User(db.Model, UserMixin):
     is_admin = db.Column(db.Boolean, default=False)   # 権限（管理者かどうか）
     slack_user_id = db.Column(db.String(50), nullable=True)  # SlackユーザーIDを保存するカラム
     max_loan_limit = db.Column(db.Integer, default=3, nullable=False)  # 最大同時貸出数
+    # 貸出・予約の件数（_refresh_user_counters で同じトランザクション内に更新する）
+    active_loans = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 貸出中
+    pending_reservations = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 予約待ち
+    overdue_loans = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 延滞中
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -35,24 +63,35 @@ class User(db.Model, UserMixin):
         self.password_hash = ph.hash(password)
         
     def check_password(self, password):
-        """パスワードをチェックする"""
+        """
+        パスワードをチェックする
+
+        照合に成功し、ハッシュのパラメータが現在の設定と異なる場合は新しい設定でハッシュし直す
+        （呼び出し側でコミットすると保存される）。照合の同時実行数が上限に達したまま
+        PASSWORD_VERIFY_TIMEOUT 秒空かない場合は PasswordVerificationBusy を送出する。
+        """
+        if not _verify_slots.acquire(timeout=_verify_timeout):
+            raise PasswordVerificationBusy()
         try:
-            return ph.verify(self.password_hash, password)
+            ph.verify(self.password_hash, password)
+            if ph.check_needs_rehash(self.password_hash):
+                self.password_hash = ph.hash(password)
+            return True
         except VerifyMismatchError:
             return False
         except Exception as e:
             print(f"Password verification error: {e}")
             return False
+        finally:
+            _verify_slots.release()
     
     def current_loan_count(self):
         """現在の貸出数を取得"""
-        active_loans = [loan for loan in self.loans if loan.is_active]
-        return len(active_loans)
+        return self.active_loans
     
     def current_reservation_count(self):
         """現在の予約数を取得"""
-        active_reservations = [r for r in self.reservations if r.status == ReservationStatus.PENDING]
-        return len(active_reservations)
+        return self.pending_reservations
     
     def can_borrow_more(self):
         """追加で本を借りられるかどうかを確認"""
@@ -61,10 +100,7 @@ class User(db.Model, UserMixin):
     
     def has_overdue_books(self):
         """延滞中の本があるかどうかを確認"""
-        for loan in self.loans:
-            if loan.is_active and loan.is_overdue():
-                return True
-        return False
+        return db.session.query(overdue_loan_exists(self.id)).scalar()
     
     def __repr__(self):
         return f'<User {self.email}>'
@@ -98,6 +134,7 @@ class Book(db.Model):
     category1 = db.Column(db.String(50), index=True)  # 第１分類
     category2 = db.Column(db.String(50))  # 第２分類
     keywords = db.Column(db.String(200))  # キーワード
+    search_text = db.Column(db.Text)  # 全文検索用テキスト（search_vectorと同期）
     location = db.Column(db.String(100))  # 場所
     borrower_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)  # 借りた人
     borrower = db.relationship('User', backref=db.backref('borrowed_books', lazy=True))
@@ -110,6 +147,12 @@ class Book(db.Model):
     reservations = db.relationship('Reservation', back_populates='book', lazy=True, cascade="all, delete-orphan")
     images = db.relationship('BookImage', back_populates='book', lazy=True, cascade="all, delete-orphan")
     
+    __table_args__ = (
+        # MySQLではngramパーサー付きのFULLTEXTインデックスとして作成される
+        db.Index('ix_books_search_text', 'search_text',
+                 mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+    
     @property
     def current_loan(self):
         """現在の貸出情報を取得"""
@@ -120,18 +163,75 @@ class Book(db.Model):
     @property
     def search_vector(self):
         """検索用のベクトルを生成"""
-        return ' '.join(filter(None, [
-            self.title,
-            self.author,
-            self.category1,
-            self.category2,
-            self.keywords
-        ])).lower()
+        return build_search_text(self.title, self.author, self.category1, self.category2, self.keywords)
 
     def __repr__(self):
         return f'<Book {self.title}>'
 
 
+def build_search_text(title, author, category1, category2, keywords):
+    """
+    全文検索用テキストを作る（一括INSERTなどでイベントを通らない場合にも使う）
+
+    検索語と同じ規則（utils.tokenizer.normalize）で正規化し、全角・半角やカタカナ・ひらがなの
+    違いがあっても絞り込みとランキングの結果が一致するようにする。
+    """
+    return normalize(' '.join(filter(None, [title, author, category1, category2, keywords])))
+
+
+@event.listens_for(Book, 'before_insert')
+@event.listens_for(Book, 'before_update')
+def _sync_book_search_text(mapper, connection, target):
+    """書籍の保存時に全文検索用テキストを更新する"""
+    target.search_text = target.search_vector
+
+
+class BookSearchTerm(db.Model):
+    """書籍検索用の転置インデックス（n-gram → 書籍のポスティングリスト）"""
+    __tablename__ = 'book_search_terms'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(16), nullable=False)  # n-gramトークン
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.String(20), nullable=False)  # 出現フィールド (title, author, keywords, category)
+    term_freq = db.Column(db.Integer, nullable=False, default=1)  # フィールド内の出現回数
+    field_length = db.Column(db.Integer, nullable=False, default=0)  # フィールドのトークン数
+    
+    __table_args__ = (
+        db.Index('ix_book_search_terms_term_book', 'term', 'book_id'),
+    )
+    
+    def __repr__(self):
+        return f'<BookSearchTerm {self.term} -> {self.book_id}>'
+
+
+class BookNumberSequence(db.Model):
+    """管理番号（BO-yyyy-NNN）の年ごとの採番カウンター"""
+    __tablename__ = 'book_number_sequences'
+    
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_number = db.Column(db.Integer, nullable=False, default=0)  # 払い出し済みの最大の連番
+    
+    def __repr__(self):
+        return f'<BookNumberSequence {self.year}: {self.last_number}>'
+
+
+class BookPopularity(db.Model):
+    """人気の本のランキング（定期実行タスクで集計した結果）"""
+    __tablename__ = 'book_popularity'
+    
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, nullable=False, index=True)  # 1始まりの順位
+    score = db.Column(db.Float, nullable=False, default=0.0)  # 時間減衰を加味した人気スコア
+    loan_count = db.Column(db.Integer, nullable=False, default=0)  # 集計期間内の貸出回数
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    book = db.relationship('Book')
+    
+    def __repr__(self):
+        return f'<BookPopularity {self.rank}: {self.book_id}>'
+
+
 class LoanHistory(db.Model):
     """貸出履歴テーブル"""
     __tablename__ = 'loan_history'
@@ -149,6 +249,11 @@ class LoanHistory(db.Model):
     extension_count = db.Column(db.Integer, default=0, nullable=False)  # 延長回数
     extended_date = db.Column(db.DateTime, nullable=True)  # 延長実施日
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # 貸出可否の判定（ユーザーごとの未返却・延滞件数）用
+        db.Index('ix_loan_history_borrower_active', 'borrower_id', 'return_date', 'due_date'),
+    )
 
     @property
     def is_active(self):
@@ -205,16 +310,30 @@ class Reservation(db.Model):
     notification_sent = db.Column(db.Boolean, default=False)
     notification_sent_at = db.Column(db.DateTime, nullable=True)
     
+    # 予約待ち（PENDING）の中での順位（1始まり、それ以外の状態ではNULL）
+    # 予約の登録・状態変更時に _renumber_reservation_queues で振り直す
+    queue_rank = db.Column(db.Integer, nullable=True)
+    
     # Relationships
     user = db.relationship('User', back_populates='reservations')
     book = db.relationship('Book', back_populates='reservations')
     
+    __table_args__ = (
+        db.Index('ix_reservations_book_status_rank', 'book_id', 'status', 'queue_rank'),
+        db.Index('ix_reservations_user_status', 'user_id', 'status'),
+    )
+    
     @property
     def queue_position(self):
         """予約順位を取得"""
         if self.status != ReservationStatus.PENDING:
             return None
         
+        if self.queue_rank is not None:
+            return self.queue_rank
+        
+        # 順位が未設定の場合（移行前のデータなど）は数えて求める
+        
         # 自分より前に予約された有効な予約の数を数える + 1
         # 同じ時刻の場合はIDの小さい順
         earlier_reservations_count = Reservation.query.filter(
@@ -235,6 +354,188 @@ class Reservation(db.Model):
         return f'<Reservation {self.id} for Book {self.book_id} by User {self.user_id}>'
 
 
+def renumber_reservation_queue(connection, book_id):
+    """
+    書籍の予約待ちの順位を予約日時・ID順に振り直す
+
+    Returns:
+        dict: 予約ID -> 順位（予約待ちの予約のみ）
+    """
+    table = Reservation.__table__
+    rows = connection.execute(
+        select(table.c.id, table.c.queue_rank).where(
+            table.c.book_id == book_id,
+            table.c.status == ReservationStatus.PENDING
+        ).order_by(
+            table.c.reservation_date, table.c.id
+        ).with_for_update()
+    ).all()
+
+    ranks = {}
+    changed = []
+    for rank, (reservation_id, current_rank) in enumerate(rows, start=1):
+        ranks[reservation_id] = rank
+        if current_rank != rank:
+            changed.append({'reservation_id': reservation_id, 'rank': rank})
+    if changed:
+        connection.execute(
+            update(table).where(table.c.id == bindparam('reservation_id')).values(
+                queue_rank=bindparam('rank')
+            ),
+            changed
+        )
+
+    # 予約待ちでなくなった予約の順位を外す
+    connection.execute(
+        update(table).where(
+            table.c.book_id == book_id,
+            table.c.status != ReservationStatus.PENDING,
+            table.c.queue_rank.isnot(None)
+        ).values(queue_rank=None)
+    )
+    return ranks
+
+
+def overdue_loan_exists(user_id, now=None):
+    """
+    延滞中の貸出があるかを判定する EXISTS 句
+
+    延滞は時間の経過で発生するため、カウンター列ではなく判定のたびに
+    ix_loan_history_borrower_active (borrower_id, return_date, due_date) を使って確認する。
+
+    Args:
+        user_id: ユーザーID（または users.id の列）
+        now: 延滞判定の基準日時
+    """
+    now = now or datetime.utcnow()
+    loans = LoanHistory.__table__
+    return select(loans.c.id).where(
+        loans.c.borrower_id == user_id,
+        loans.c.return_date.is_(None),
+        loans.c.due_date < now
+    ).exists()
+
+
+def refresh_user_counters(connection, user_ids=None, now=None):
+    """
+    ユーザーの貸出中・予約待ち・延滞中の件数を集計し直す
+
+    Args:
+        connection: 実行に使うコネクション
+        user_ids: 対象のユーザーID（Noneの場合は全ユーザー）
+        now: 延滞判定の基準日時
+
+    Returns:
+        int: 更新した行数
+    """
+    now = now or datetime.utcnow()
+    users = User.__table__
+    loans = LoanHistory.__table__
+    reservations = Reservation.__table__
+
+    active_loans = select(func.count(loans.c.id)).where(
+        loans.c.borrower_id == users.c.id,
+        loans.c.return_date.is_(None)
+    ).scalar_subquery()
+    overdue_loans = select(func.count(loans.c.id)).where(
+        loans.c.borrower_id == users.c.id,
+        loans.c.return_date.is_(None),
+        loans.c.due_date < now
+    ).scalar_subquery()
+    pending_reservations = select(func.count(reservations.c.id)).where(
+        reservations.c.user_id == users.c.id,
+        reservations.c.status == ReservationStatus.PENDING
+    ).scalar_subquery()
+
+    statement = update(users).values(
+        active_loans=active_loans,
+        pending_reservations=pending_reservations,
+        overdue_loans=overdue_loans,
+        updated_at=users.c.updated_at  # 集計値の更新では更新日時を変えない
+    )
+    if user_ids is not None:
+        statement = statement.where(users.c.id.in_(user_ids))
+    return connection.execute(statement).rowcount
+
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_user_counters(session, flush_context):
+    """貸出・予約の登録や状態変更があったユーザーの件数を同じトランザクションで更新する"""
+    watched = {
+        LoanHistory: ('borrower_id', ('borrower_id', 'return_date', 'due_date')),
+        Reservation: ('user_id', ('user_id', 'status')),
+    }
+    user_ids = set()
+    for obj in session.new.union(session.deleted):
+        if type(obj) in watched:
+            user_ids.add(getattr(obj, watched[type(obj)][0]))
+    for obj in session.dirty:
+        if type(obj) not in watched:
+            continue
+        owner, names = watched[type(obj)]
+        state = inspect(obj)
+        for name in names:
+            history = state.attrs[name].history
+            if history.has_changes():
+                user_ids.add(getattr(obj, owner))
+                if name == owner:
+                    user_ids.update(history.deleted)
+    user_ids.discard(None)
+    if not user_ids:
+        return
+
+    connection = session.connection()
+    refresh_user_counters(connection, user_ids)
+
+    # セッション内のユーザーにも新しい件数を反映する
+    loaded = {
+        obj.id: obj for obj in session.identity_map.values()
+        if isinstance(obj, User) and obj.id in user_ids
+    }
+    if loaded:
+        users = User.__table__
+        rows = connection.execute(
+            select(users.c.id, users.c.active_loans, users.c.pending_reservations, users.c.overdue_loans)
+            .where(users.c.id.in_(loaded))
+        )
+        for user_id, active, pending, overdue in rows:
+            attributes.set_committed_value(loaded[user_id], 'active_loans', active)
+            attributes.set_committed_value(loaded[user_id], 'pending_reservations', pending)
+            attributes.set_committed_value(loaded[user_id], 'overdue_loans', overdue)
+
+
+@event.listens_for(Session, 'after_flush')
+def _renumber_reservation_queues(session, flush_context):
+    """予約の登録・状態変更・削除があった書籍の予約順位を同じトランザクションで振り直す"""
+    book_ids = set()
+    for obj in session.new.union(session.deleted):
+        if isinstance(obj, Reservation):
+            book_ids.add(obj.book_id)
+    for obj in session.dirty:
+        if not isinstance(obj, Reservation):
+            continue
+        state = inspect(obj)
+        for name in ('status', 'book_id', 'reservation_date'):
+            history = state.attrs[name].history
+            if history.has_changes():
+                book_ids.add(obj.book_id)
+                if name == 'book_id':
+                    book_ids.update(history.deleted)
+    book_ids.discard(None)
+    if not book_ids:
+        return
+
+    connection = session.connection()
+    ranks = {}
+    for book_id in sorted(book_ids):
+        ranks.update(renumber_reservation_queue(connection, book_id))
+
+    # セッション内のオブジェクトにも新しい順位を反映する（追加のSELECTを発生させない）
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Reservation) and obj.book_id in book_ids:
+            attributes.set_committed_value(obj, 'queue_rank', ranks.get(obj.id))
+
+
 class OperationLog(db.Model):
     """操作ログモデル"""
     __tablename__ = 'operation_logs'
@@ -287,6 +588,106 @@ class CategoryLocationMapping(db.Model):
         return f'<CategoryLocationMapping {self.category1} -> {self.default_location}>'
 
 
+class NotificationStatus(Enum):
+    """通知の送信状態"""
+    PENDING = 'pending'  # 送信待ち
+    SENT = 'sent'        # 送信済み
+    FAILED = 'failed'    # 再試行の上限に達した
+
+
+class NotificationOutbox(db.Model):
+    """通知の送信待ちキュー（業務処理と同じトランザクションで登録し、ディスパッチャーが送信する）"""
+    __tablename__ = 'notification_outbox'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False, default='slack_dm')  # 送信手段
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum(NotificationStatus), nullable=False, default=NotificationStatus.PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # 送信を試みた回数
+    last_error = db.Column(db.String(500))
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 次に送信を試みる日時
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    user = db.relationship('User')
+    
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<NotificationOutbox {self.id} {self.channel} -> {self.user_id}>'
+
+
+class JobStatus(Enum):
+    """バックグラウンドジョブの状態"""
+    QUEUED = '待機中'
+    RUNNING = '処理中'
+    COMPLETED = '完了'
+    FAILED = '失敗'
+
+
+class Job(db.Model):
+    """CSVインポートなど、時間のかかる処理のバックグラウンドジョブ"""
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # 処理の種類（import_books, import_users）
+    status = db.Column(db.Enum(JobStatus), nullable=False, default=JobStatus.QUEUED)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)  # 依頼したユーザー
+    file_path = db.Column(db.String(255))  # アップロードされたファイルの保存先
+    filename = db.Column(db.String(255))  # 元のファイル名（表示用）
+    ip_address = db.Column(db.String(50))
+    total = db.Column(db.Integer, nullable=False, default=0)  # 処理対象の件数
+    processed = db.Column(db.Integer, nullable=False, default=0)  # 処理済みの件数
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)  # エラーメッセージ（JSONの配列）
+    message = db.Column(db.String(500))  # 結果の概要
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # 処理中のワーカーが最後に進捗を記録した日時
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    user = db.relationship('User')
+    
+    __table_args__ = (
+        db.Index('ix_jobs_status_created', 'status', 'created_at'),
+    )
+    
+    @property
+    def error_list(self):
+        return json.loads(self.errors) if self.errors else []
+    
+    @property
+    def is_finished(self):
+        return self.status in (JobStatus.COMPLETED, JobStatus.FAILED)
+    
+    @property
+    def percent(self):
+        if self.is_finished:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, int(self.processed * 100 / self.total))
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status.name}>'
+
+
+class SlackUserCache(db.Model):
+    """メールアドレスとSlackユーザーIDの対応のキャッシュ（users.list の同期と個別検索の結果）"""
+    __tablename__ = 'slack_user_cache'
+    
+    email = db.Column(db.String(120), primary_key=True)  # 小文字に正規化したメールアドレス
+    slack_user_id = db.Column(db.String(50), nullable=True)  # 見つからなかった場合はNULL
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<SlackUserCache {self.email} -> {self.slack_user_id}>'
+
+
 class BookImage(db.Model):
     """書籍画像テーブル"""
     __tablename__ = 'book_images'
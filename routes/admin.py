@@ -1,11 +1,11 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
-import csv
 import os
-import chardet
+import uuid
 
-from services.user_service import create_user, get_user_by_id, update_user, delete_user, import_users_from_csv
+from services.user_service import create_user, get_user_by_id, update_user, delete_user
+from services.job_service import enqueue_job
 from utils.decorators import admin_required
 from models import User, db, OperationLog, Announcement, CategoryLocationMapping
 from forms.user import NewUserForm, EditUserForm
@@ -125,30 +125,15 @@ def import_users():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
+            # 同時にアップロードされたファイルと衝突しないよう一意な名前で保存する
             filename = secure_filename(file.filename)
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
+            filepath = os.path.join(UPLOAD_FOLDER, f'{uuid.uuid4().hex}_{filename}')
             file.save(filepath)
             
-            try:
-                success_count, error_count, errors = import_users_from_csv(filepath)
-
-                if success_count > 0:
-                    flash(f'{success_count}件のユーザーを登録しました。', 'success')
-                if error_count > 0:
-                    flash(f'{error_count}件の登録に失敗しました。詳細は以下の通りです。', 'danger')
-                    for error in errors[:10]:
-                        flash(error, 'danger')
-                    if len(errors) > 10:
-                        flash(f'他 {len(errors) - 10}件のエラーがあります。', 'warning')
-
-            except Exception as e:
-                db.session.rollback()
-                flash(f'CSVファイルの処理中にエラーが発生しました: {str(e)}', 'danger')
-            finally:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            
-            return redirect(url_for('admin.users'))
+            # 登録はバックグラウンドのジョブで実行し、進捗画面に移動する
+            job = enqueue_job('import_users', current_user.id, filepath, file.filename, request.remote_addr)
+            flash('ユーザー登録を受け付けました。処理状況はこの画面で確認できます。', 'info')
+            return redirect(url_for('jobs.detail', job_id=job.id))
         
         flash('許可されていないファイル形式です。CSVファイルをアップロードしてください。', 'danger')
         return redirect(request.url)
@@ -1,11 +1,26 @@
 # routes/api.py
 from flask import Blueprint, jsonify, request, current_app
+from flask_login import login_required
 from models import db, LoanHistory, User, CategoryLocationMapping
+from services.email_service import mail_pool
+from services.loan_service import LoanService
+from services.suggest_service import suggest_index
 from utils.decorators import api_key_required
 from datetime import datetime, timedelta
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+# 一括貸出・返却で1回に指定できる冊数
+MAX_BULK_ITEMS = 200
+
+def _bulk_book_numbers(data):
+    """リクエストの book_numbers を検証して管理番号のリストを返す（不正な場合はNone）"""
+    book_numbers = data.get('book_numbers')
+    if not isinstance(book_numbers, list) or not book_numbers or len(book_numbers) > MAX_BULK_ITEMS:
+        return None
+    book_numbers = [str(number).strip() for number in book_numbers if str(number).strip()]
+    return book_numbers or None
+
 @api_bp.route('/loans', methods=['GET'])
 @api_key_required
 def get_loans():
@@ -42,6 +57,82 @@ def get_loans():
 
     return jsonify(output)
 
+@api_bp.route('/loans/bulk-return', methods=['POST'])
+@api_key_required
+def bulk_return():
+    """
+    複数の本をまとめて返却する
+
+    リクエスト: {"book_numbers": ["BO-2024-001", ...]}
+    """
+    data = request.get_json(silent=True) or {}
+    book_numbers = _bulk_book_numbers(data)
+    if book_numbers is None:
+        return jsonify({"error": f"book_numbers must be a list of 1-{MAX_BULK_ITEMS} book numbers"}), 400
+
+    try:
+        result = LoanService.bulk_return_books(book_numbers, ip_address=request.remote_addr)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Bulk return failed: {str(e)}")
+        return jsonify({"error": "Bulk return failed"}), 500
+
+    return jsonify(result)
+
+@api_bp.route('/loans/bulk-borrow', methods=['POST'])
+@api_key_required
+def bulk_borrow():
+    """
+    複数の本をまとめて1人のユーザーに貸し出す
+
+    リクエスト: {"user_id": 1 または "email": "...", "book_numbers": [...], "due_date": "YYYY-MM-DD"(任意)}
+    """
+    data = request.get_json(silent=True) or {}
+    book_numbers = _bulk_book_numbers(data)
+    if book_numbers is None:
+        return jsonify({"error": f"book_numbers must be a list of 1-{MAX_BULK_ITEMS} book numbers"}), 400
+
+    if data.get('user_id') is not None:
+        user = db.session.get(User, data.get('user_id'))
+    elif data.get('email'):
+        user = User.query.filter_by(email=data.get('email')).first()
+    else:
+        return jsonify({"error": "user_id or email is required"}), 400
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    due_date = None
+    if data.get('due_date'):
+        try:
+            due_date = datetime.strptime(data['due_date'], '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return jsonify({"error": "due_date must be YYYY-MM-DD"}), 400
+
+    try:
+        result = LoanService.bulk_borrow_books(
+            user.id, book_numbers, due_date=due_date, ip_address=request.remote_addr
+        )
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Bulk borrow failed: {str(e)}")
+        return jsonify({"error": "Bulk borrow failed"}), 500
+
+    return jsonify(result)
+
+@api_bp.route('/mail/stats', methods=['GET'])
+@api_key_required
+def mail_stats():
+    """メール送信ワーカーの統計（送信済み・失敗・受付拒否・送信待ちの件数）を取得する"""
+    return jsonify(mail_pool.stats())
+
+@api_bp.route('/books/suggest', methods=['GET'])
+@login_required
+def suggest_books():
+    """書籍のタイトル・著者名の入力補完候補を取得する"""
+    prefix = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 20)
+    return jsonify(suggest_index.suggest(prefix, limit=limit))
+
 @api_bp.route('/categories/<category1>', methods=['GET'])
 def get_category2_options(category1):
     """第1分類に基づいて第2分類の選択肢を取得"""
@@ -3,7 +3,7 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
 from urllib.parse import urlparse
 
-from models import User, db, OperationLog
+from models import User, db, OperationLog, PasswordVerificationBusy
 from forms.auth import LoginForm, SignupForm
 
 # ★★★ デバッグログ追加 ★★★
@@ -43,18 +43,20 @@ def login():
         try:
             user = User.query.filter_by(email=submitted_email).first()
 
+            # パスワードの照合（Argon2）は1回だけ行う
+            password_ok = user is not None and user.check_password(form.password.data)
+
             # ★★★ デバッグログ追加 ★★★
             if user:
-                log.info(f"User found in DB: {user.email} (ID: {user.id}, Hash: {user.password_hash[:10]}...) ") # ハッシュの一部を表示
-                password_check_result = user.check_password(form.password.data)
-                log.info(f"Password check result for '{user.email}': {password_check_result}")
-                if not password_check_result:
+                log.info(f"User found in DB: {user.email} (ID: {user.id})")
+                log.info(f"Password check result for '{user.email}': {password_ok}")
+                if not password_ok:
                      log.warning("Password check failed.") # 失敗時に警告レベルで記録
             else:
                 log.warning(f"User '{submitted_email}' not found in DB.") # ユーザーが見つからない場合も警告
             # ★★★★★★★★★★★★★★★★
 
-            if user is None or not user.check_password(form.password.data):
+            if not password_ok:
                 flash('メールアドレスまたはパスワードが正しくありません。', 'danger')
                 # ★★★ デバッグログ追加 ★★★
                 log.warning("Authentication failed. Rendering login page again.")
@@ -83,6 +85,11 @@ def login():
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('home.dashboard'))
 
+        except PasswordVerificationBusy:
+            log.warning(f"Password verification is busy. Rejected login for '{submitted_email}'.")
+            flash('ログインが混み合っています。しばらくしてから再度お試しください。', 'warning')
+            return render_template('auth/login.html', form=form), 503
+
         except Exception as e:
             # ★★★ デバッグログ追加 ★★★
             log.error(f"Error during login process for user '{submitted_email}': {e}", exc_info=True) # エラー詳細を記録
@@ -1,18 +1,22 @@
 # routes/books.py
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_required, current_user
-from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
-import csv
 import os
+import uuid
 from datetime import datetime, timedelta
-import chardet
 import requests
 
 from models import Book, LoanHistory, Reservation, OperationLog, db, User, ReservationStatus, BookStatus, CategoryLocationMapping
-from services.book_service import borrow_book, return_book, reserve_book, cancel_reservation, create_book_with_auto_number, update_book_status
+from services.book_service import borrow_book, return_book, reserve_book, cancel_reservation, create_book_with_auto_number, update_book_status, get_borrowed_books
 from services.loan_service import LoanService
-from services.slack_service import send_slack_dm_to_user
+from services.outbox_service import enqueue_slack_dm
+from services.search_service import filter_books_by_keyword, rank_books
+from services.facet_service import compute_book_facets
+from services.job_service import enqueue_job
+from utils.pagination import SimplePage, encode_cursor, keyset_paginate
+from utils.sql_profiler import query_budget
 from forms.search import SearchForm
 from forms.book import BookForm, CATEGORIES
 from forms.book_forms import BorrowForm, ExtendLoanForm
@@ -23,6 +27,9 @@ books_bp = Blueprint('books', __name__, url_prefix='/books')
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'csv'}
 
+# 書籍一覧の1ページあたりの最大件数
+MAX_PER_PAGE = 200
+
 # アップロードディレクトリの作成
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -32,6 +39,7 @@ def allowed_file(filename):
 
 @books_bp.route('/')
 @login_required
+@query_budget(6)
 def index():
     """書籍一覧を表示"""
     form = SearchForm(request.args)  # request.argsからフォームを初期化
@@ -41,17 +49,24 @@ def index():
         category2_choices = CATEGORIES.get(form.category1.data, [])
         form.category2.choices = [('', '選択してください')] + category2_choices
     
-    query = Book.query
+    selected_status = BookStatus[form.status.data] if form.status.data in BookStatus.__members__ else None
     
-    # キーワード検索
-    if form.keyword.data:
-        query = query.filter(
-            or_(
-                Book.title.ilike(f'%{form.keyword.data}%'),
-                Book.author.ilike(f'%{form.keyword.data}%'),
-                Book.keywords.ilike(f'%{form.keyword.data}%')
-            )
-        )
+    # ファセット（分類・状態ごとの件数）をキーワード条件のみで1回のクエリで集計
+    keyword_query = filter_books_by_keyword(Book.query, form.keyword.data)
+    facets = compute_book_facets(
+        keyword_query,
+        category1=form.category1.data,
+        category2=form.category2.data if form.category1.data else None,
+        status=selected_status
+    )
+    form.category1.choices = [('', '選択してください')] + [
+        (cat, f"{cat} ({facets['category1'].get(cat, 0)})") for cat in CATEGORIES.keys()
+    ]
+    form.status.choices = [('', 'すべて')] + [
+        (s.name, f"{s.value} ({facets['status'][s.name]})") for s in BookStatus
+    ]
+    
+    query = Book.query
     
     # 分類での絞り込み
     if form.category1.data and form.category1.data != '':
@@ -60,26 +75,73 @@ def index():
         if form.category2.data and form.category2.data != '':
             query = query.filter(Book.category2 == form.category2.data)
     
-    # 並び替え
-    query = query.order_by(Book.title)
-    
-    books = query.all()
-    return render_template('books/index.html', books=books, form=form, categories=CATEGORIES)
+    # 状態での絞り込み
+    if selected_status:
+        query = query.filter(Book.status == selected_status)
+    
+    # ページネーション
+    per_page = request.args.get('per_page', current_app.config['BOOKS_PER_PAGE'], type=int)
+    per_page = min(max(per_page, 1), MAX_PER_PAGE)
+    page = max(request.args.get('page', 1, type=int), 1)
+    cursor = request.args.get('cursor')
+    pagination = None
+    next_cursor = None
+    
+    if form.keyword.data and form.sort.data != 'title':
+        # キーワード検索（関連度順）: 表示するページ分のみDBから取得
+        # 絞り込みは並び順によらず同じ条件（ファセットの件数とも一致）にし、BM25は並び替えだけに使う
+        query = filter_books_by_keyword(query, form.keyword.data)
+        offset = (page - 1) * per_page
+        limit = min(per_page + 1, current_app.config['SEARCH_RESULT_LIMIT'] - offset)
+        ranked = rank_books(query, form.keyword.data, limit=limit, offset=offset) if limit > 0 else []
+        page_info = SimplePage(ranked[:per_page], per_page, page=page, has_next=len(ranked) > per_page)
+    else:
+        # キーワード検索（全文検索インデックスを使用）
+        query = filter_books_by_keyword(query, form.keyword.data)
+        
+        if cursor:
+            # 深いページはキーセット方式（タイトル, ID）で取得
+            page_info = keyset_paginate(query, (Book.title, Book.id), cursor, per_page)
+            next_cursor = page_info.next_cursor
+        else:
+            pagination = query.order_by(Book.title, Book.id).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            page_info = pagination
+            if pagination.has_next and pagination.items:
+                last_book = pagination.items[-1]
+                next_cursor = encode_cursor((last_book.title, last_book.id))
+    
+    # ページ送りのリンクに引き継ぐ検索条件
+    page_args = {k: v for k, v in request.args.items() if k not in ('page', 'cursor')}
+    
+    return render_template('books/index.html',
+                         books=page_info.items,
+                         page_info=page_info,
+                         pagination=pagination,
+                         next_cursor=next_cursor,
+                         page_args=page_args,
+                         facets=facets,
+                         form=form,
+                         categories=CATEGORIES)
 
 @books_bp.route('/book/<int:book_id>')
 @login_required
+@query_budget(6)
 def book_detail(book_id):
     """書籍の詳細を表示"""
-    book = Book.query.get_or_404(book_id)
+    book = Book.query.options(joinedload(Book.borrower)).get_or_404(book_id)
     
     # 現在の予約状況
     reservations = Reservation.query.filter_by(
         book_id=book.id,
         status=ReservationStatus.PENDING
-    ).order_by(Reservation.reservation_date).all()
+    ).order_by(Reservation.queue_rank).all()
     
-    # 貸出履歴
-    history = LoanHistory.query.filter_by(book_id=book.id).order_by(LoanHistory.loan_date.desc()).all()
+    # 貸出履歴（借りた人を同時に取得）
+    history = LoanHistory.query.options(
+        joinedload(LoanHistory.borrower)
+    ).filter_by(book_id=book.id).order_by(LoanHistory.loan_date.desc()).all()
     
     # 自分の予約状況
     user_reservation = Reservation.query.filter_by(
@@ -88,12 +150,16 @@ def book_detail(book_id):
         status=ReservationStatus.PENDING
     ).first()
     
+    # 貸出・予約の可否
+    eligibility = LoanService.get_borrow_eligibility(current_user.id)
+    
     return render_template(
         'books/detail.html',
         book=book,
         reservations=reservations,
         history=history,
-        user_reservation=user_reservation
+        user_reservation=user_reservation,
+        eligibility=eligibility
     )
 
 @books_bp.route('/book/borrow/<int:book_id>', methods=['GET', 'POST'])
@@ -120,25 +186,6 @@ def borrow(book_id):
         if success:
             flash('本を借りました。', 'success')
             
-            # 貸出記録を取得
-            loan = LoanHistory.query.filter_by(
-                book_id=book_id,
-                borrower_id=current_user.id,
-                return_date=None
-            ).first()
-            
-            # Slack通知を送信
-            if loan and loan.book:
-                book_url = f"http://localhost/books/book/{book_id}"
-                message = (
-                    f"図書管理アプリです！以下の本の貸出がされました。\n"
-                    f"書籍：<{book_url}|{loan.book.title}>\n"
-                    f"返却期限：{loan.due_date.strftime('%Y-%m-%d')}\n\n"
-                    f"返却期限を守り、書籍は元の場所へ返却するようお願いいたします。"
-                )
-                # 貸し出した本人にDMを送信
-                send_slack_dm_to_user(current_user, message)
-            
             # 書籍の状態を更新
             book = Book.query.get(book_id)
             update_book_status(book)
@@ -188,7 +235,7 @@ def return_book_route(book_id):
         f"ご利用ありがとうございました。"
     )
     # 返却した本人にDMを送信
-    send_slack_dm_to_user(current_user, return_message)
+    enqueue_slack_dm(current_user, return_message)
 
     # 返却日時を設定
     loan.return_date = datetime.utcnow()
@@ -201,7 +248,7 @@ def return_book_route(book_id):
     next_reservation = Reservation.query.filter_by(
         book_id=book_id,
         status=ReservationStatus.PENDING
-    ).order_by(Reservation.reservation_date).first()
+    ).order_by(Reservation.queue_rank).first()
     
     if next_reservation:
         # 予約者のステータスを更新
@@ -218,7 +265,7 @@ def return_book_route(book_id):
             f"期限までに貸出手続きをお願いいたします。"
         )
         # 予約者にDMを送信
-        send_slack_dm_to_user(next_reservation.user, reservation_message)
+        enqueue_slack_dm(next_reservation.user, reservation_message)
         flash(f'{next_reservation.user.name} さんに予約書籍が利用可能になったことを通知しました。', 'info')
         
         # 書籍の状態を予約済みに更新
@@ -244,15 +291,6 @@ def reserve(book_id):
     success, result = reserve_book(book_id, current_user.id)
     
     if success:
-        book = Book.query.get_or_404(book_id)
-        book_url = f"http://localhost/books/book/{book_id}"
-        message = (
-            f"図書管理アプリです！以下の本を予約しました。\n"
-            f"書籍：<{book_url}|{book.title}>\n\n"
-            f"貸出可能になりましたら、改めてご連絡します。"
-        )
-        # 予約した本人にDMを送信
-        send_slack_dm_to_user(current_user, message)
         flash(result, 'success')
         
         # 操作ログの記録
@@ -279,13 +317,6 @@ def cancel(reservation_id):
     success, result = cancel_reservation(reservation_id, current_user.id)
     
     if success:
-        book_url = f"http://localhost/books/book/{book_id}"
-        message = (
-            f"図書管理アプリです！以下の本の予約をキャンセルしました。\n"
-            f"書籍：<{book_url}|{reservation.book.title}>"
-        )
-        # キャンセルした本人にDMを送信
-        send_slack_dm_to_user(current_user, message)
         flash(result, 'success')
         
         # 操作ログの記録
@@ -346,17 +377,23 @@ def add():
 
 @books_bp.route('/my/books')
 @login_required
+@query_budget(8)
 def my_books():
     """自分が借りている書籍一覧"""
-    borrowed_books = Book.query.filter_by(borrower_id=current_user.id).all()
+    borrowed_books = get_borrowed_books(current_user.id)
     
     # 自分の予約一覧
-    reservations = Reservation.query.filter_by(
+    reservations = Reservation.query.options(
+        joinedload(Reservation.book)
+    ).filter_by(
         user_id=current_user.id,
         status=ReservationStatus.PENDING
     ).order_by(Reservation.reservation_date).all()
     
-    return render_template('books/my_books.html', borrowed_books=borrowed_books, reservations=reservations)
+    # 貸出状況サマリー
+    eligibility = LoanService.get_borrow_eligibility(current_user.id)
+    
+    return render_template('books/my_books.html', borrowed_books=borrowed_books, reservations=reservations, eligibility=eligibility)
 
 @books_bp.route('/import', methods=['GET', 'POST'])
 @login_required
@@ -377,127 +414,15 @@ def import_books():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
+            # 同時にアップロードされたファイルと衝突しないよう一意な名前で保存する
             filename = secure_filename(file.filename)
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
+            filepath = os.path.join(UPLOAD_FOLDER, f'{uuid.uuid4().hex}_{filename}')
             file.save(filepath)
             
-            success_count = 0
-            error_count = 0
-            errors = []
-            books_to_add = []
-            
-            try:
-                # ファイルの文字コードを自動判定
-                with open(filepath, 'rb') as f:
-                    raw_data = f.read()
-                    result = chardet.detect(raw_data)
-                    encoding = result['encoding'] if result['encoding'] else 'utf-8'
-                
-                with open(filepath, 'r', encoding=encoding, newline='') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    
-                    # ヘッダーの正規化と存在確認
-                    reader.fieldnames = [h.lower().strip() for h in reader.fieldnames]
-                    required_headers = ['title']
-                    if not all(h in reader.fieldnames for h in required_headers):
-                        missing_headers = [h for h in required_headers if h not in reader.fieldnames]
-                        flash(f'必須列が不足しています: {", ".join(missing_headers)}', 'danger')
-                        return redirect(request.url)
-                    
-                    for row_num, row in enumerate(reader, start=2):
-                        try:
-                            title = row.get('title', '').strip()
-                            if not title:
-                                errors.append(f'行 {row_num}: title は必須です。')
-                                error_count += 1
-                                continue
-                            
-                            # 書籍の重複をチェック（タイトルと著者で簡易的に）
-                            author = row.get('author', '').strip()
-                            if Book.query.filter_by(title=title, author=author).first():
-                                errors.append(f'行 {row_num}: 既に同じ書籍（タイトルと著者が一致）が存在します: {title}')
-                                error_count += 1
-                                continue
-
-                            # 場所の妥当性チェック
-                            location = row.get('location', '').strip()
-                            category1 = row.get('category1', '').strip()
-                            
-                            if location and category1:
-                                # 指定されたカテゴリに対して設定されている場所かチェック
-                                from models import CategoryLocationMapping
-                                valid_location = CategoryLocationMapping.query.filter_by(
-                                    category1=category1, 
-                                    default_location=location
-                                ).first()
-                                
-                                if not valid_location:
-                                    # このカテゴリで使用可能な場所を取得
-                                    available_locations = CategoryLocationMapping.query.filter_by(
-                                        category1=category1
-                                    ).all()
-                                    if available_locations:
-                                        location_list = [loc.default_location for loc in available_locations]
-                                        errors.append(f'行 {row_num}: カテゴリ「{category1}」には場所「{location}」は設定されていません。使用可能な場所: {", ".join(location_list)}')
-                                    else:
-                                        errors.append(f'行 {row_num}: カテゴリ「{category1}」には場所が設定されていません。')
-                                    error_count += 1
-                                    continue
-
-                            # CSVインポート用: 書籍オブジェクトを準備（自動番号は後で一括生成）
-                            book_data = {
-                                'title': title,
-                                'author': author,
-                                'category1': category1,
-                                'category2': row.get('category2', '').strip(),
-                                'keywords': row.get('keywords', '').strip(),
-                                'location': location
-                            }
-                            books_to_add.append(book_data)
-                            
-                        except Exception as e:
-                            error_count += 1
-                            errors.append(f'行 {row_num} の処理中に予期せぬエラー: {str(e)}')
-
-                # エラーがある場合はインポート処理を中断
-                if error_count > 0:
-                    flash('CSVファイル内にエラーが検出されたため、インポートを中断しました。', 'danger')
-                    for error in errors[:10]:
-                        flash(error, 'danger')
-                    if len(errors) > 10:
-                        flash(f'他 {len(errors) - 10} 件のエラーがあります。', 'warning')
-                    return redirect(url_for('books.import_books'))
-
-                # エラーがなければ一括でコミット（自動番号生成付き）
-                if books_to_add:
-                    created_books = []
-                    for book_data in books_to_add:
-                        book = create_book_with_auto_number(**book_data)
-                        created_books.append(book)
-                    success_count = len(created_books)
-                    
-                    # 操作ログの記録
-                    log = OperationLog(
-                        user_id=current_user.id,
-                        action='import_books',
-                        target=f'Imported {success_count} books',
-                        ip_address=request.remote_addr
-                    )
-                    db.session.add(log)
-                    db.session.commit()
-                    
-                    flash(f'{success_count}件の書籍を正常に登録しました。', 'success')
-
-            except Exception as e:
-                db.session.rollback()
-                flash(f'CSVファイルの処理中に予期せぬエラーが発生しました: {str(e)}', 'danger')
-                current_app.logger.error(f'CSV import error: {str(e)}')
-            
-            finally:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            
-            return redirect(url_for('books.index'))
+            # インポートはバックグラウンドのジョブで実行し、進捗画面に移動する
+            job = enqueue_job('import_books', current_user.id, filepath, file.filename, request.remote_addr)
+            flash('インポートを受け付けました。処理状況はこの画面で確認できます。', 'info')
+            return redirect(url_for('jobs.detail', job_id=job.id))
         
         flash('許可されていないファイル形式です。CSVファイルをアップロードしてください。', 'danger')
         return redirect(request.url)
@@ -667,16 +592,6 @@ def extend_loan(loan_id):
         if success:
             flash(message, 'success')
             
-            # Slack通知
-            book_url = f"http://localhost/books/book/{loan.book_id}"
-            slack_message = (
-                f"図書管理アプリです！貸出期間が延長されました。\n"
-                f"書籍：<{book_url}|{loan.book.title}>\n"
-                f"新しい返却期限：{loan.due_date.strftime('%Y-%m-%d')}\n\n"
-                f"返却期限を守り、返却の際、本は自分で戻してください。"
-            )
-            send_slack_dm_to_user(current_user, slack_message)
-            
             # 操作ログの記録
             log = OperationLog(
                 user_id=current_user.id,
@@ -1,25 +1,36 @@
 from flask import Blueprint, render_template, request
 from flask_wtf import FlaskForm
 from flask_login import login_required, current_user
-from datetime import datetime, timedelta
+from datetime import datetime
 from sqlalchemy import func, desc, and_
+from sqlalchemy.orm import contains_eager
 from models import db, LoanHistory, Book, Reservation, User, BookStatus, Announcement, ReservationStatus
 from services.book_service import get_popular_books
+from utils.sql_profiler import query_budget
 
 home_bp = Blueprint('home', __name__)
 
 @home_bp.route('/')
 @login_required
+@query_budget(8)
 def dashboard():
-    """ユーザーのパーソナライズされたホームダッシュボード"""
+    """
+    ユーザーのパーソナライズされたホームダッシュボード
+
+    予約・貸出の件数に関わらず、発行するクエリは固定の件数
+    （貸出・予約・人気の本・新着・お知らせ）に収まるようにする。
+    予約順位は reservations.queue_rank に保持しているため追加のクエリは不要。
+    """
     
-    # 現在の貸出状況
-    current_loans = LoanHistory.query.filter(
+    # 現在の貸出状況（書籍も同時に読み込む）
+    current_loans = LoanHistory.query.join(Book).options(
+        contains_eager(LoanHistory.book)
+    ).filter(
         and_(
             LoanHistory.borrower_id == current_user.id,
             LoanHistory.return_date.is_(None)
         )
-    ).join(Book).all()
+    ).all()
     
     # 返却期限が近い本（3日以内）
     due_soon = []
@@ -32,13 +43,15 @@ def dashboard():
             elif days_until_due <= 3:
                 due_soon.append(loan)
     
-    # 現在の予約状況（有効な予約のみ）
-    current_reservations = Reservation.query.filter(
+    # 現在の予約状況（有効な予約のみ、書籍も同時に読み込む）
+    current_reservations = Reservation.query.join(Book).options(
+        contains_eager(Reservation.book)
+    ).filter(
         and_(
             Reservation.user_id == current_user.id,
             Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.NOTIFIED])
         )
-    ).join(Book).all()
+    ).all()
     
     # 予約している本のうち、貸出可能になったものを特定
     available_reservations = []
@@ -52,9 +65,8 @@ def dashboard():
     current_loan_count = len(current_loans)
     available_loan_slots = max_loans - current_loan_count
     
-    # 人気の本（最近1ヶ月の貸出数）
-    one_month_ago = datetime.now() - timedelta(days=30)
-    popular_books = get_popular_books(limit=5, since=one_month_ago)
+    # 人気の本（定期実行タスクで集計済みのランキング）
+    popular_books = get_popular_books(limit=5)
     
     # 最近追加された本
     recent_books = Book.query.filter_by(status=BookStatus.AVAILABLE).order_by(
@@ -0,0 +1,50 @@
+# routes/jobs.py
+from flask import Blueprint, render_template, jsonify, abort
+from flask_login import login_required, current_user
+
+from models import Job
+
+jobs_bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+# ジョブの種類ごとの表示名と、完了後の戻り先
+JOB_KINDS = {
+    'import_books': ('書籍一括インポート', 'books.index'),
+    'import_users': ('ユーザー一括登録', 'admin.users'),
+}
+
+def _get_job_or_404(job_id):
+    """ジョブを取得する（依頼したユーザーと管理者のみ参照できる）"""
+    job = Job.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        abort(404)
+    return job
+
+def _job_to_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status.name,
+        'status_label': job.status.value,
+        'total': job.total,
+        'processed': job.processed,
+        'percent': job.percent,
+        'success_count': job.success_count,
+        'error_count': job.error_count,
+        'errors': job.error_list if job.is_finished else [],
+        'message': job.message,
+        'finished': job.is_finished,
+    }
+
+@jobs_bp.route('/<int:job_id>')
+@login_required
+def detail(job_id):
+    """ジョブの進捗画面"""
+    job = _get_job_or_404(job_id)
+    title, back_endpoint = JOB_KINDS.get(job.kind, (job.kind, 'home.dashboard'))
+    return render_template('jobs/detail.html', job=job, title=title, back_endpoint=back_endpoint)
+
+@jobs_bp.route('/<int:job_id>/status')
+@login_required
+def status(job_id):
+    """ジョブの進捗を取得する（進捗画面からポーリングする）"""
+    return jsonify(_job_to_dict(_get_job_or_404(job_id)))
@@ -2,7 +2,7 @@
 from flask import Blueprint, request, redirect, url_for, flash, render_template
 from flask_login import login_required, current_user
 from models import db, Reservation, Book, OperationLog, ReservationStatus, LoanHistory
-from services.slack_service import send_slack_dm_to_user
+from services.outbox_service import enqueue_slack_dm
 from datetime import datetime
 
 # Blueprintの設定 - 'reservations'という名前で登録
@@ -42,9 +42,8 @@ def create(book_id):
         ip_address=request.remote_addr
     )
     db.session.add(log)
-    db.session.commit()
     
-    # 現在この本を借りているユーザーに通知
+    # 現在この本を借りているユーザーへの通知（予約と同じトランザクションで登録する）
     current_loan = LoanHistory.query.filter_by(
         book_id=book_id,
         return_date=None
@@ -60,7 +59,8 @@ def create(book_id):
             f"*予約者：* {current_user.name}\n\n"
             f":warning: この本は延長ができなくなります。返却期限までにご返却をお願いいたします。"
         )
-        send_slack_dm_to_user(borrower, message)
+        enqueue_slack_dm(borrower, message)
+    db.session.commit()
     
     flash('書籍を予約しました。', 'success')
     return redirect(url_for('books.book_detail', book_id=book_id))
@@ -130,11 +130,11 @@ def borrow_from_reservation(reservation_id):
     
     # 貸出処理
     from services.book_service import borrow_book
-    result = borrow_book(reservation.book_id, current_user.id)
+    success, result = borrow_book(reservation.book_id, current_user.id)
     
-    if "成功" in result:
-        # 予約を完了状態に更新
-        reservation.status = ReservationStatus.COMPLETED
+    if success:
+        # 予約を完了状態に更新（予約順位は自動で振り直される）
+        reservation.status = ReservationStatus.FULFILLED
         
         # 操作ログの記録
         log = OperationLog(
@@ -164,7 +164,7 @@ def book_reservations(book_id):
     reservations = Reservation.query.filter_by(
         book_id=book_id,
         status=ReservationStatus.PENDING
-    ).order_by(Reservation.reservation_date).all()
+    ).order_by(Reservation.queue_rank).all()
     
     return render_template(
         'reservations/book_reservations.html',
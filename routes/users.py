@@ -1,10 +1,13 @@
 # routes/users.py
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
 
 from services.user_service import update_user
-from models import User, db, OperationLog, Book, Reservation
+from models import User, db, OperationLog, Reservation, ReservationStatus
 from forms.user import ProfileForm
+from services.book_service import get_borrowed_books
+from utils.sql_profiler import query_budget
 
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -149,15 +152,18 @@ def delete_user(user_id):
 
 @users_bp.route('/my-page')
 @login_required
+@query_budget(8)
 def my_page():
     """マイページを表示"""
     # 貸出中の書籍
-    borrowed_books = Book.query.filter_by(borrower_id=current_user.id).all()
+    borrowed_books = get_borrowed_books(current_user.id)
     
     # 予約中の書籍
-    reservations = Reservation.query.filter_by(
+    reservations = Reservation.query.options(
+        joinedload(Reservation.book)
+    ).filter_by(
         user_id=current_user.id,
-        status='pending'
+        status=ReservationStatus.PENDING
     ).order_by(Reservation.reservation_date).all()
     
     return render_template('users/my_page.html',
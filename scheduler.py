@@ -6,6 +6,9 @@
 1. 返却期限通知 (3日前)
 2. 予約可能通知 (返却された本の予約待ち通知)
 3. 期限切れ予約のクリーンアップ (7日間放置された予約)
+4. 人気の本のランキング集計
+5. ユーザーごとの貸出・予約・延滞件数の再集計
+6. SlackユーザーIDの同期 (users.list の取り込み)
 
 使用例：
 毎日午前9時に実行
@@ -21,10 +24,14 @@ from datetime import datetime, timedelta
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
 from flask import url_for
+from sqlalchemy import func, update
+from sqlalchemy.orm import joinedload
 
 from models import db, User, Book, LoanHistory, Reservation, ReservationStatus
-from services.slack_service import send_slack_dm_to_user
+from services.slack_service import send_slack_dms, sync_slack_user_ids
 from services.book_service import release_book_from_reservation
+from services.popularity_service import refresh_book_popularity
+from services.user_service import reconcile_user_counters
 
 # ロギング設定
 def setup_logging():
@@ -50,75 +57,102 @@ def setup_app_context():
     return app
 
 def check_due_date_reminders(logger):
-    """返却期限が近い貸出のリマインダーを送信"""
+    """
+    返却期限が近い貸出のリマインダーを送信
+
+    DMはレート制限を守りながら並行して送信し、送信できた貸出の reminder_sent を
+    1回のUPDATEでまとめて更新する。
+    """
     now = datetime.utcnow()
     reminder_date = now + timedelta(days=3)
     
-    loans = LoanHistory.query.filter(
+    loans = LoanHistory.query.options(
+        joinedload(LoanHistory.book),
+        joinedload(LoanHistory.borrower)
+    ).filter(
         LoanHistory.return_date.is_(None),
         LoanHistory.reminder_sent.is_(False),
         LoanHistory.due_date <= reminder_date,
         LoanHistory.due_date > now
     ).all()
+    if not loans:
+        logger.info('送信すべき返却期限リマインダーはありませんでした')
+        return 0
     
-    reminder_count = 0
+    # 書籍ごとの予約待ち件数を1回のクエリで取得する
+    reservation_counts = dict(db.session.query(
+        Reservation.book_id,
+        func.count(Reservation.id)
+    ).filter(
+        Reservation.book_id.in_({loan.book_id for loan in loans}),
+        Reservation.status == ReservationStatus.PENDING
+    ).group_by(Reservation.book_id).all())
+    
+    notifications = []
     for loan in loans:
+        days_remaining = (loan.due_date.date() - now.date()).days
+        
+        # URL生成を簡略化
+        base_url = 'http://localhost'
+        book_url = f"{base_url}/books/book/{loan.book_id}"
+        extend_url = f"{base_url}/books/loan/extend/{loan.id}"
+        
+        # 延長可能かチェック
+        can_extend = loan.extension_count == 0
+        reservation_count = reservation_counts.get(loan.book_id, 0)
+        has_reservations = reservation_count > 0
+        
+        message = (
+            f":books: *図書管理システム* - 返却期限のお知らせ\n\n"
+            f"*書籍：* <{book_url}|{loan.book.title}>\n"
+            f"*返却期限：* {loan.due_date.strftime('%Y年%m月%d日')} (*残り{days_remaining}日*)\n\n"
+        )
+        
+        if can_extend and not has_reservations:
+            message += (
+                f":clock1: *貸出期間の延長が可能です！*\n"
+                f"<{extend_url}|こちらから延長手続き>ができます（1週間または2週間）\n\n"
+            )
+        elif has_reservations:
+            message += (
+                f":warning: この本には{reservation_count}件の予約があるため、延長はできません。\n\n"
+            )
+        elif not can_extend:
+            message += (
+                f":warning: この本は既に延長済みのため、再延長はできません。\n\n"
+            )
+        
+        message += f"期限内のご返却にご協力をお願いいたします。:pray:"
+        notifications.append((loan.id, loan.borrower, message))
+    
+    # 貸出者にDMを送信
+    try:
+        sent_ids = send_slack_dms(notifications)
+    except Exception as e:
+        logger.error(f"Error sending due date reminders: {e}")
+        db.session.rollback()
+        return 0
+    
+    failed_ids = [loan_id for loan_id, _, _ in notifications if loan_id not in sent_ids]
+    if failed_ids:
+        logger.warning(f"Failed to send due date reminders for loans {failed_ids}")
+    
+    if sent_ids:
         try:
-            days_remaining = (loan.due_date.date() - datetime.utcnow().date()).days
-            
-            # URL生成を簡略化
-            base_url = 'http://localhost'
-            book_url = f"{base_url}/books/book/{loan.book_id}"
-            extend_url = f"{base_url}/books/loan/extend/{loan.id}"
-            
-            # 延長可能かチェック
-            can_extend = loan.extension_count == 0
-            reservation_count = Reservation.query.filter_by(book_id=loan.book_id, status='pending').count()
-            has_reservations = reservation_count > 0
-            
-            message = (
-                f":books: *図書管理システム* - 返却期限のお知らせ\n\n"
-                f"*書籍：* <{book_url}|{loan.book.title}>\n"
-                f"*返却期限：* {loan.due_date.strftime('%Y年%m月%d日')} (*残り{days_remaining}日*)\n\n"
+            db.session.execute(
+                update(LoanHistory).where(LoanHistory.id.in_(sent_ids)).values(reminder_sent=True),
+                execution_options={'synchronize_session': False}
             )
-            
-            if can_extend and not has_reservations:
-                message += (
-                    f":clock1: *貸出期間の延長が可能です！*\n"
-                    f"<{extend_url}|こちらから延長手続き>ができます（1週間または2週間）\n\n"
-                )
-            elif has_reservations:
-                message += (
-                    f":warning: この本には{reservation_count}件の予約があるため、延長はできません。\n\n"
-                )
-            elif not can_extend:
-                message += (
-                    f":warning: この本は既に延長済みのため、再延長はできません。\n\n"
-                )
-            
-            message += f"期限内のご返却にご協力をお願いいたします。:pray:"
-            
-            # 貸出者にDMを送信
-            success = send_slack_dm_to_user(loan.borrower, message)
-
-            if success:
-                loan.reminder_sent = True
-                db.session.add(loan)
-                db.session.commit()
-                reminder_count += 1
-                logger.info(f"Due date reminder sent for loan {loan.id}")
-            else:
-                logger.warning(f"Failed to send due date reminder for loan {loan.id}")
+            db.session.commit()
         except Exception as e:
-            logger.error(f"Error sending reminder for loan {loan.id}: {e}")
+            logger.error(f"Error recording sent reminders: {e}")
             db.session.rollback()
-
-    if reminder_count > 0:
-        logger.info(f'返却期限リマインダーを {reminder_count} 件送信しました')
+            return 0
+        logger.info(f'返却期限リマインダーを {len(sent_ids)} 件送信しました')
     else:
-        logger.info('送信すべき返却期限リマインダーはありませんでした')
+        logger.info('送信できた返却期限リマインダーはありませんでした')
     
-    return reminder_count
+    return len(sent_ids)
 
 def cleanup_expired_reservations(logger):
     """期限切れ予約をクリーンアップ"""
@@ -149,6 +183,42 @@ def cleanup_expired_reservations(logger):
     
     return cancelled_count
 
+def refresh_popular_books(logger):
+    """人気の本のランキングを集計し直す"""
+    try:
+        count = refresh_book_popularity()
+        logger.info(f'人気の本のランキングを {count} 冊で更新しました')
+        return count
+    except Exception as e:
+        logger.error(f"Error refreshing popular books: {e}")
+        db.session.rollback()
+        return 0
+
+def refresh_user_counters(logger):
+    """延滞件数など、時間の経過で変わるユーザーの件数を集計し直す"""
+    try:
+        count = reconcile_user_counters()
+        logger.info(f'{count} 人のユーザーの貸出件数を再集計しました')
+        return count
+    except Exception as e:
+        logger.error(f"Error reconciling user counters: {e}")
+        db.session.rollback()
+        return 0
+
+def sync_slack_users(logger):
+    """SlackのユーザーIDをまとめて同期する（リマインダー送信時の個別検索を省く）"""
+    try:
+        result = sync_slack_user_ids()
+        if result is None:
+            logger.warning('Slackのユーザー一覧を取得できなかったため、同期をスキップしました')
+            return 0
+        logger.info(f'Slackユーザー {result[0]} 人を取り込み、{result[1]} 人のSlack IDを更新しました')
+        return result[1]
+    except Exception as e:
+        logger.error(f"Error syncing Slack users: {e}")
+        db.session.rollback()
+        return 0
+
 def main():
     """メイン実行関数"""
     logger = setup_logging()
@@ -159,8 +229,11 @@ def main():
         with app.app_context():
             # url_forが動作するようにリクエストコンテキストをプッシュ
             with app.test_request_context():
+                sync_slack_users(logger)
                 check_due_date_reminders(logger)
                 cleanup_expired_reservations(logger)
+                refresh_popular_books(logger)
+                refresh_user_counters(logger)
         
         logger.info('定期実行タスクが正常に完了しました')
         
@@ -1,9 +1,38 @@
 # services/book_service.py
+import csv
 from datetime import datetime, timedelta
-from models import db, Book, LoanHistory, Reservation, OperationLog, User, CategoryLocationMapping, BookStatus
+from models import (db, Book, BookNumberSequence, BookPopularity, BookSearchTerm, LoanHistory, Reservation, OperationLog, User,
+                    CategoryLocationMapping, BookStatus, ReservationStatus, build_search_text)
 from flask import current_app
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 from .loan_service import LoanService
+from .outbox_service import enqueue_slack_dm
+from .search_service import build_term_rows, index_fields
+from .suggest_service import suggest_index
+from utils.encoding import detect_encoding
+
+# デフォルトの分類 → 場所の対応（CategoryLocationMapping に設定がない場合に使う）
+DEFAULT_CATEGORY_LOCATIONS = {
+    'プログラミング': 'A棚-1',
+    'データベース': 'A棚-2', 
+    'ネットワーク': 'A棚-3',
+    'AI・機械学習': 'B棚-1',
+    'ビジネス': 'C棚-1',
+    '経営': 'C棚-2',
+    'マーケティング': 'C棚-3',
+    '自己啓発': 'D棚-1',
+    '小説': 'E棚-1',
+    'エッセイ': 'E棚-2',
+    '歴史': 'F棚-1',
+    '哲学': 'F棚-2',
+    '科学': 'G棚-1',
+    '数学': 'G棚-2',
+}
+
+# CSVインポートで1回のINSERTにまとめる件数
+IMPORT_CHUNK_SIZE = 500
 
 def borrow_book(book_id, user_id, due_date=None):
     """書籍を貸し出す処理（新しい制限ロジック使用）"""
@@ -46,7 +75,7 @@ def reserve_book(book_id, user_id):
     existing_reservation = Reservation.query.filter_by(
         book_id=book_id,
         user_id=user_id,
-        status='pending'
+        status=ReservationStatus.PENDING
     ).first()
     
     if existing_reservation:
@@ -59,6 +88,14 @@ def reserve_book(book_id, user_id):
     )
     
     db.session.add(reservation)
+    
+    # 予約した本人への通知（予約と同じトランザクションで登録する）
+    book_url = f"http://localhost/books/book/{book_id}"
+    enqueue_slack_dm(user, (
+        f"図書管理アプリです！以下の本を予約しました。\n"
+        f"書籍：<{book_url}|{book.title}>\n\n"
+        f"貸出可能になりましたら、改めてご連絡します。"
+    ))
     db.session.commit()
     
     current_app.logger.info(f"Book {book_id} reserved by user {user_id}")
@@ -73,16 +110,49 @@ def cancel_reservation(reservation_id, user_id):
         return False, "この予約はあなたのものではありません。"
     
     # 予約キャンセル処理
-    reservation.status = 'cancelled'
+    reservation.status = ReservationStatus.CANCELLED
     
+    # キャンセルした本人への通知（キャンセルと同じトランザクションで登録する）
+    book_url = f"http://localhost/books/book/{reservation.book_id}"
+    enqueue_slack_dm(reservation.user, (
+        f"図書管理アプリです！以下の本の予約をキャンセルしました。\n"
+        f"書籍：<{book_url}|{reservation.book.title}>"
+    ))
     db.session.commit()
     
     current_app.logger.info(f"Reservation {reservation_id} cancelled by user {user_id}")
     return True, "予約がキャンセルされました。"
 
+def get_borrowed_books(user_id):
+    """
+    ユーザーが借りている書籍一覧を取得する
+
+    テンプレートで参照する book.current_loan と loan.can_extend() が書籍ごとに
+    追加のSELECTを発行しないよう、未返却の貸出と予約待ちの予約を同時に読み込む。
+    """
+    return Book.query.options(
+        selectinload(Book.loans.and_(LoanHistory.return_date.is_(None))),
+        selectinload(Book.reservations.and_(Reservation.status == ReservationStatus.PENDING))
+    ).filter_by(borrower_id=user_id).all()
+
 def get_popular_books(limit=5, since=None):
-    """人気の本を取得する（貸出回数順）"""
+    """
+    人気の本を取得する
+
+    since を指定しない場合は、定期実行タスクで集計済みの book_popularity から
+    上位 limit 件を読む（未集計の場合は過去30日の貸出回数で集計する）。
+    """
     if since is None:
+        rankings = BookPopularity.query.options(
+            joinedload(BookPopularity.book)
+        ).order_by(BookPopularity.rank).limit(limit).all()
+        if rankings:
+            result = []
+            for ranking in rankings:
+                book = ranking.book
+                book.loan_count = ranking.loan_count  # 動的にloan_countを追加
+                result.append(book)
+            return result
         since = datetime.now() - timedelta(days=30)  # デフォルトは過去30日
     
     # 貸出回数でグループ化して人気順に並べる
@@ -106,30 +176,62 @@ def get_popular_books(limit=5, since=None):
     
     return result
 
-def generate_book_number(year=None):
-    """自動管理番号を生成する（BO-yyyy-001形式）"""
+def format_book_number(year, number):
+    """管理番号の文字列を作る（BO-yyyy-001形式、1000以降は桁が増える）"""
+    return f"BO-{year}-{number:03d}"
+
+def _last_issued_number(year):
+    """既存の書籍の管理番号から、その年の最大の連番を求める（カウンターの初期値用）"""
+    last_number = 0
+    for (book_number,) in db.session.query(Book.book_number).filter(Book.book_number.like(f"BO-{year}-%")):
+        try:
+            last_number = max(last_number, int(book_number.rsplit('-', 1)[-1]))
+        except ValueError:
+            continue
+    return last_number
+
+def reserve_book_numbers(count, year=None):
+    """
+    管理番号を count 件まとめて払い出す
+
+    年ごとのカウンター行を SELECT ... FOR UPDATE でロックして連続した番号を確保するため、
+    同時に書籍を登録しても番号が重複しない。ロックはトランザクションの終了まで保持される。
+
+    Args:
+        count: 払い出す件数
+        year: 対象の年（省略時は今年）
+
+    Returns:
+        list: 管理番号のリスト（連番）
+    """
+    if count <= 0:
+        return []
     if year is None:
         year = datetime.now().year
-    
-    # 該当年の最大連番を取得
-    prefix = f"BO-{year}-"
-    last_book = Book.query.filter(
-        Book.book_number.like(f"{prefix}%")
-    ).order_by(
-        Book.book_number.desc()
-    ).first()
-    
-    if last_book and last_book.book_number:
+
+    sequence = BookNumberSequence.query.filter_by(year=year).with_for_update().first()
+    if sequence is None:
+        # その年の最初の採番では、既存の番号の続きからカウンターを作る
         try:
-            # 最後の3桁の番号を抽出
-            last_number = int(last_book.book_number.split('-')[-1])
-            next_number = last_number + 1
-        except (ValueError, IndexError):
-            next_number = 1
-    else:
-        next_number = 1
-    
-    return f"BO-{year}-{next_number:03d}"
+            with db.session.begin_nested():
+                db.session.add(BookNumberSequence(year=year, last_number=_last_issued_number(year)))
+        except IntegrityError:
+            pass  # 他のトランザクションが先に作成した
+        sequence = BookNumberSequence.query.filter_by(year=year).populate_existing().with_for_update().one()
+
+    start = sequence.last_number + 1
+    db.session.execute(
+        update(BookNumberSequence).where(BookNumberSequence.year == year).values(
+            last_number=BookNumberSequence.last_number + count
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.expire(sequence)
+    return [format_book_number(year, number) for number in range(start, start + count)]
+
+def generate_book_number(year=None):
+    """自動管理番号を1件払い出す（BO-yyyy-001形式）"""
+    return reserve_book_numbers(1, year)[0]
 
 def create_book_with_auto_number(title, author, category1=None, category2=None, 
                                 keywords=None, location=None, **kwargs):
@@ -164,37 +266,171 @@ def get_location_for_category(category):
     if mapping:
         return mapping.default_location
     
-    # デフォルトのマッピング
-    category_mapping = {
-        'プログラミング': 'A棚-1',
-        'データベース': 'A棚-2', 
-        'ネットワーク': 'A棚-3',
-        'AI・機械学習': 'B棚-1',
-        'ビジネス': 'C棚-1',
-        '経営': 'C棚-2',
-        'マーケティング': 'C棚-3',
-        '自己啓発': 'D棚-1',
-        '小説': 'E棚-1',
-        'エッセイ': 'E棚-2',
-        '歴史': 'F棚-1',
-        '哲学': 'F棚-2',
-        '科学': 'G棚-1',
-        '数学': 'G棚-2',
+    return DEFAULT_CATEGORY_LOCATIONS.get(category, '未分類')
+
+def _insert_imported_books(rows):
+    """
+    インポートする書籍をまとめてINSERTし、検索用のポスティングリストも作成する
+
+    管理番号はチャンクの件数分をまとめて払い出す。一括INSERTでは書籍のイベント
+    （search_text の設定・ポスティングリストの作成）が実行されないため、ここで同じ処理を行う。
+    """
+    now = datetime.utcnow()
+    book_numbers = reserve_book_numbers(len(rows))
+    for row, book_number in zip(rows, book_numbers):
+        row['book_number'] = book_number
+        row['search_text'] = build_search_text(
+            row['title'], row['author'], row['category1'], row['category2'], row['keywords']
+        )
+        row['status'] = BookStatus.AVAILABLE
+        row['is_available'] = True
+        row['registration_date'] = now
+        row['created_at'] = now
+        row['updated_at'] = now
+    db.session.execute(insert(Book), rows)
+
+    # MySQLの一括INSERTではIDを受け取れないため、管理番号から引き直す
+    ids = dict(db.session.execute(
+        select(Book.book_number, Book.id).where(Book.book_number.in_([row['book_number'] for row in rows]))
+    ).all())
+    term_rows = []
+    for row in rows:
+        row['id'] = ids[row['book_number']]
+        term_rows.extend(build_term_rows(row['id'], index_fields(
+            row['title'], row['author'], row['keywords'], row['category1'], row['category2']
+        )))
+    if term_rows:
+        db.session.execute(insert(BookSearchTerm), term_rows)
+
+def import_books_from_csv(file_path, user_id, ip_address=None, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    CSVファイルから書籍を一括インポートする
+
+    ファイルは1行ずつ読み、既存書籍の (タイトル, 著者) と分類ごとの場所の設定は
+    最初に1回だけ読み込んで照合する。書籍は chunk_size 件ずつINSERTし、
+    1件でもエラーがあれば全体をロールバックする（全件を1トランザクションで登録する）。
+
+    Args:
+        file_path: CSVファイルのパス
+        user_id: 操作ログに記録するユーザーID
+        ip_address: 操作ログに記録するIPアドレス
+        chunk_size: 1回のINSERTにまとめる件数
+        progress: 処理済みの行数を受け取る関数（chunk_size 行ごとに呼び出す）
+
+    Returns:
+        tuple: (登録件数, エラー件数, エラーメッセージのリスト)
+    """
+    errors = []
+
+    existing_keys = {
+        (title, author or '') for title, author in db.session.query(Book.title, Book.author)
     }
-    
-    return category_mapping.get(category, '未分類')
+    locations = {}
+    for category1, location in db.session.query(
+        CategoryLocationMapping.category1, CategoryLocationMapping.default_location
+    ).order_by(CategoryLocationMapping.id):
+        locations.setdefault(category1, []).append(location)
+
+    imported_keys = set()
+    created = []  # (ID, タイトル, 著者)
+    chunk = []
+    encoding = detect_encoding(file_path)
+    with open(file_path, 'r', encoding=encoding, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+
+        # ヘッダーの正規化と存在確認
+        reader.fieldnames = [h.lower().strip() for h in reader.fieldnames or []]
+        required_headers = ['title']
+        missing_headers = [h for h in required_headers if h not in reader.fieldnames]
+        if missing_headers:
+            return 0, 1, [f'必須列が不足しています: {", ".join(missing_headers)}']
+
+        for row_num, row in enumerate(reader, start=2):
+            try:
+                title = (row.get('title') or '').strip()
+                if not title:
+                    errors.append(f'行 {row_num}: title は必須です。')
+                    continue
+
+                # 書籍の重複をチェック（タイトルと著者で簡易的に）
+                author = (row.get('author') or '').strip()
+                if (title, author) in existing_keys:
+                    errors.append(f'行 {row_num}: 既に同じ書籍（タイトルと著者が一致）が存在します: {title}')
+                    continue
+                if (title, author) in imported_keys:
+                    errors.append(f'行 {row_num}: このCSVファイル内で同じ書籍（タイトルと著者が一致）が重複しています: {title}')
+                    continue
+                imported_keys.add((title, author))
+
+                # 場所の妥当性チェック
+                location = (row.get('location') or '').strip()
+                category1 = (row.get('category1') or '').strip()
+                if location and category1 and location not in locations.get(category1, []):
+                    if locations.get(category1):
+                        errors.append(f'行 {row_num}: カテゴリ「{category1}」には場所「{location}」は設定されていません。使用可能な場所: {", ".join(locations[category1])}')
+                    else:
+                        errors.append(f'行 {row_num}: カテゴリ「{category1}」には場所が設定されていません。')
+                    continue
+
+                # カテゴリベースの自動ロケーション割り当て
+                if not location and category1:
+                    location = (locations.get(category1) or [DEFAULT_CATEGORY_LOCATIONS.get(category1, '未分類')])[0]
+
+                chunk.append({
+                    'title': title,
+                    'author': author,
+                    'category1': category1,
+                    'category2': (row.get('category2') or '').strip(),
+                    'keywords': (row.get('keywords') or '').strip(),
+                    'location': location,
+                })
+            except Exception as e:
+                errors.append(f'行 {row_num} の処理中に予期せぬエラー: {str(e)}')
+
+            # エラーが見つかった後は登録せず、残りの行の検証だけを続ける
+            if errors:
+                chunk = []
+            elif len(chunk) >= chunk_size:
+                _insert_imported_books(chunk)
+                created.extend((r['id'], r['title'], r['author']) for r in chunk)
+                chunk = []
+
+            if progress and (row_num - 1) % chunk_size == 0:
+                progress(row_num - 1)
+
+    if errors:
+        db.session.rollback()
+        return 0, len(errors), errors
+
+    if chunk:
+        _insert_imported_books(chunk)
+        created.extend((r['id'], r['title'], r['author']) for r in chunk)
+
+    if created:
+        db.session.add(OperationLog(
+            user_id=user_id,
+            action='import_books',
+            target=f'Imported {len(created)} books',
+            ip_address=ip_address
+        ))
+    db.session.commit()
+
+    for book_id, title, author in created:
+        suggest_index.update(book_id, title, author)
+    current_app.logger.info(f"Imported {len(created)} books from CSV")
+    return len(created), 0, []
 
 def release_book_from_reservation(book):
     """予約から本をリリースする（返却時やキャンセル時）"""
     # 次の予約待ちユーザーがいる場合の処理
     next_reservation = Reservation.query.filter_by(
         book_id=book.id,
-        status='pending'
-    ).order_by(Reservation.reservation_date).first()
+        status=ReservationStatus.PENDING
+    ).order_by(Reservation.queue_rank).first()
     
     if next_reservation:
         # 予約待ちの最初のユーザーに通知
-        next_reservation.status = 'notified'
+        next_reservation.status = ReservationStatus.NOTIFIED
         next_reservation.notification_sent_at = datetime.utcnow()
         book.status = BookStatus.RESERVED
     else:
@@ -1,67 +1,271 @@
-from flask import current_app, render_template
+from flask import current_app
 from flask_mail import Message
+from jinja2 import TemplateNotFound
 from datetime import datetime, timedelta
 import logging
 import os
-from threading import Thread
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 
-def send_async_email(app, msg):
-    """非同期でメールを送信"""
-    with app.app_context():
+class MailWorkerPool:
+    """
+    メール送信用の固定数のワーカースレッドと上限付きキュー
+
+    ワーカーはキューに溜まったメールを MAIL_BATCH_SIZE 通ずつ取り出し、
+    1回のSMTP接続（mail.connect()）でまとめて送信する。
+    キューが満杯の場合は MAIL_ENQUEUE_TIMEOUT 秒だけ待ち、それでも空かなければ受け付けない。
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'queued': 0, 'sent': 0, 'failed': 0, 'rejected': 0, 'batches': 0}
+
+    def _start(self, app):
+        with self._lock:
+            if self._queue is not None:
+                return
+            self._queue = queue.Queue(maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000))
+            for i in range(app.config.get('MAIL_WORKERS', 2)):
+                thread = threading.Thread(target=self._run, args=(app,), name=f'mail-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def stats(self):
+        """送信件数などの統計とキューに溜まっている件数を返す"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+    def submit(self, app, msg):
+        """
+        メールを送信キューに追加する
+
+        Returns:
+            bool: 受け付けた場合はTrue（キューが満杯のままの場合はFalse）
+        """
+        if self._queue is None:
+            self._start(app)
+        try:
+            self._queue.put(msg, timeout=app.config.get('MAIL_ENQUEUE_TIMEOUT', 1))
+        except queue.Full:
+            self._count('rejected')
+            logger.error(f"Mail queue is full ({self._queue.maxsize}); dropped email: {msg.subject}")
+            return False
+        self._count('queued')
+        return True
+
+    def _next_batch(self, batch_size):
+        batch = [self._queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, app):
+        from app import mail
+        batch_size = app.config.get('MAIL_BATCH_SIZE', 20)
+        while True:
+            batch = self._next_batch(batch_size)
+            with app.app_context():
+                self._send_batch(mail, batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _send_batch(self, mail, batch):
+        sent = failed = 0
         try:
-            from app import mail
-            mail.send(msg)
+            with mail.connect() as connection:
+                for msg in batch:
+                    try:
+                        connection.send(msg)
+                        sent += 1
+                    except Exception as e:
+                        failed += 1
+                        logger.error(f"Failed to send email '{msg.subject}': {str(e)}")
         except Exception as e:
-            logger.error(f"Failed to send async email: {str(e)}")
+            # 接続できなかった・途中で切断された場合は未送信の残りを失敗とする
+            failed = len(batch) - sent
+            logger.error(f"Failed to send email batch: {str(e)}")
+        self._count('sent', sent)
+        self._count('failed', failed)
+        self._count('batches')
 
-def send_email(subject, recipients, template, **kwargs):
+
+mail_pool = MailWorkerPool()
+
+class EmailTemplateRegistry:
     """
-    メールを送信する汎用関数
-    
+    templates/emails/ のテンプレート（.html と .txt の組）のキャッシュ
+
+    起動時に一度だけテンプレートを探してコンパイルし、存在しない方の形式も記録しておく。
+    送信のたびにテンプレートの検索や例外処理を行わずに済む。
+    """
+
+    EXTENSIONS = ('html', 'txt')
+
+    def __init__(self):
+        self._templates = {}  # テンプレート名 -> {'html': Template または None, 'txt': ...}
+        self._lock = threading.Lock()
+
+    def load(self, app):
+        """emails/ 以下のテンプレートを全てコンパイルして登録する"""
+        names = {
+            name.rsplit('.', 1)[0]
+            for name in app.jinja_env.list_templates(extensions=self.EXTENSIONS)
+            if name.startswith('emails/')
+        }
+        for name in names:
+            self._resolve(app, name)
+        logger.info(f"Loaded {len(names)} email templates")
+
+    def _resolve(self, app, name):
+        variants = {}
+        for ext in self.EXTENSIONS:
+            try:
+                variants[ext] = app.jinja_env.get_template(f'{name}.{ext}')
+            except TemplateNotFound:
+                variants[ext] = None
+        with self._lock:
+            self._templates[name] = variants
+        return variants
+
+    def get(self, app, name):
+        """テンプレート名から {'html': Template または None, 'txt': ...} を返す"""
+        variants = self._templates.get(name)
+        if variants is None:
+            variants = self._resolve(app, name)
+        elif app.jinja_env.auto_reload and any(t is not None and not t.is_up_to_date for t in variants.values()):
+            # 開発時はテンプレートの変更を反映する
+            variants = self._resolve(app, name)
+        return variants
+
+    def render_batch(self, app, name, subjects_and_contexts):
+        """
+        同じテンプレートで複数の宛先分をまとめてレンダリングする
+
+        Args:
+            app: Flaskアプリケーション
+            name: テンプレート名（拡張子なし）
+            subjects_and_contexts: (件名, テンプレート変数の辞書) のリスト
+
+        Returns:
+            list: (HTML本文, テキスト本文) のリスト
+        """
+        variants = self.get(app, name)
+        html_template, text_template = variants['html'], variants['txt']
+        if html_template is None:
+            logger.error(f"HTML template '{name}.html' not found")
+        if text_template is None:
+            logger.warning(f"Text template '{name}.txt' not found")
+
+        # コンテキストプロセッサーの値は1回だけ計算する
+        base_context = {}
+        app.update_template_context(base_context)
+
+        rendered = []
+        for subject, context in subjects_and_contexts:
+            context = {**base_context, **context}
+
+            html = None
+            if html_template is not None:
+                try:
+                    html = html_template.render(context)
+                except Exception as e:
+                    logger.error(f"Failed to render HTML template '{name}.html': {str(e)}")
+            if html is None:
+                html = f"<p>Message content could not be rendered properly.</p>"
+
+            body = None
+            if text_template is not None:
+                try:
+                    body = text_template.render(context)
+                except Exception as e:
+                    logger.warning(f"Failed to render text template '{name}.txt': {str(e)}")
+            if body is None:
+                # HTMLからプレーンテキストを生成する簡易的な方法
+                body = f"This is a plain text version of the email. Subject: {subject}"
+
+            rendered.append((html, body))
+        return rendered
+
+
+email_templates = EmailTemplateRegistry()
+
+def init_email_templates(app):
+    """起動時にメールテンプレートを読み込む"""
+    email_templates.load(app)
+
+def _mail_enabled():
+    return os.environ.get('MAIL_ENABLED', 'false').lower() in ['true', '1', 'yes']
+
+def send_templated_emails(template, messages):
+    """
+    同じテンプレートのメールを複数の宛先にまとめて送信する
+
     Args:
-        subject (str): メールの件名
-        recipients (list): 受信者のメールアドレスリスト
         template (str): 使用するテンプレート名（拡張子なし）
-        **kwargs: テンプレートに渡す追加の変数
+        messages (list): (件名, 受信者, テンプレート変数の辞書) のリスト
+
+    Returns:
+        list: 送信キューに追加できたかどうか（messages と同じ順序）
     """
+    if not messages:
+        return []
+
     # メール機能が無効化されている場合はスキップ
-    if not os.environ.get('MAIL_ENABLED', 'false').lower() in ['true', '1', 'yes']:
-        logger.info(f"Email sending disabled. Would have sent: {subject} to {recipients}")
-        return True
-    
+    if not _mail_enabled():
+        for subject, recipients, _ in messages:
+            logger.info(f"Email sending disabled. Would have sent: {subject} to {recipients}")
+        return [True] * len(messages)
+
     try:
         app = current_app._get_current_object()
-        
+        rendered = email_templates.render_batch(
+            app, template, [(subject, context) for subject, _, context in messages]
+        )
+    except Exception as e:
+        logger.error(f"Failed to prepare email: {str(e)}")
+        return [False] * len(messages)
+
+    results = []
+    for (subject, recipients, _), (html, body) in zip(messages, rendered):
         msg = Message(
             subject=subject,
             recipients=recipients if isinstance(recipients, list) else [recipients]
         )
-        
-        # HTMLとテキスト両方のテンプレートを使用
-        try:
-            msg.html = render_template(f'{template}.html', **kwargs)
-        except Exception as e:
-            logger.error(f"Failed to render HTML template '{template}.html': {str(e)}")
-            msg.html = f"<p>Message content could not be rendered properly.</p>"
-        
-        # テキスト版のテンプレートがある場合は使用
-        try:
-            msg.body = render_template(f'{template}.txt', **kwargs)
-        except Exception as e:
-            logger.warning(f"Text template '{template}.txt' not found or error: {str(e)}")
-            # HTMLからプレーンテキストを生成する簡易的な方法
-            msg.body = f"This is a plain text version of the email. Subject: {subject}"
-        
-        # メール送信を非同期で行う
-        Thread(target=send_async_email, args=(app, msg)).start()
-        
-        logger.info(f"Email queued for sending to {recipients}: {subject}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to prepare email: {str(e)}")
-        return False
+        msg.html = html
+        msg.body = body
+
+        # メール送信をワーカーに任せる（キューが満杯の場合は送信しない）
+        queued = mail_pool.submit(app, msg)
+        if queued:
+            logger.info(f"Email queued for sending to {recipients}: {subject}")
+        results.append(queued)
+    return results
+
+def send_email(subject, recipients, template, **kwargs):
+    """
+    メールを送信する汎用関数
+    
+    Args:
+        subject (str): メールの件名
+        recipients (list): 受信者のメールアドレスリスト
+        template (str): 使用するテンプレート名（拡張子なし）
+        **kwargs: テンプレートに渡す追加の変数
+    """
+    return send_templated_emails(template, [(subject, recipients, kwargs)])[0]
 
 def send_reservation_notification(user, book):
     """
@@ -82,25 +286,39 @@ def send_reservation_notification(user, book):
         expiry_date=expiry_date
     )
 
+def _due_date_reminder_message(loan):
+    days_remaining = (loan.due_date - datetime.utcnow()).days
+    return (
+        f"【返却期限のお知らせ】{loan.book_title}",
+        loan.borrower.email,
+        dict(user=loan.borrower, book=loan.book, loan=loan, days_remaining=days_remaining)
+    )
+
 def send_due_date_reminder(loan):
     """
     返却期限リマインダーを送信する
     """
-    if not loan.borrower or not loan.borrower.email:
-        logger.warning(f"Cannot send due date reminder for loan {loan.id}: No borrower email")
-        return False
-    
-    days_remaining = (loan.due_date - datetime.utcnow()).days
-    
-    return send_email(
-        f"【返却期限のお知らせ】{loan.book_title}",
-        loan.borrower.email,
+    return bool(send_due_date_reminders([loan]))
+
+def send_due_date_reminders(loans):
+    """
+    複数の貸出の返却期限リマインダーを、テンプレートを1回だけ解決してまとめて送信する
+
+    Returns:
+        list: 送信キューに追加できた貸出
+    """
+    targets = []
+    for loan in loans:
+        if not loan.borrower or not loan.borrower.email:
+            logger.warning(f"Cannot send due date reminder for loan {loan.id}: No borrower email")
+            continue
+        targets.append(loan)
+
+    results = send_templated_emails(
         "emails/due_date_reminder",
-        user=loan.borrower,
-        book=loan.book,
-        loan=loan,
-        days_remaining=days_remaining
+        [_due_date_reminder_message(loan) for loan in targets]
     )
+    return [loan for loan, queued in zip(targets, results) if queued]
 
 def send_borrow_confirmation(loan):
     """
@@ -0,0 +1,59 @@
+"""
+書籍検索画面のファセット（分類・状態ごとの件数）を集計するサービス
+"""
+
+from sqlalchemy import func
+
+from models import Book, BookStatus
+
+
+def compute_book_facets(query, category1=None, category2=None, status=None):
+    """
+    分類・状態ごとの書籍数を1回のGROUP BYクエリで集計する
+
+    各ファセットの件数は「そのファセット以外の選択条件」を適用した値になる
+    （例: 第１分類の件数は状態の選択だけを反映し、第１分類の選択自体は反映しない）。
+
+    Args:
+        query: キーワード条件のみを適用した Book のクエリ
+        category1: 選択中の第１分類
+        category2: 選択中の第２分類
+        status: 選択中の状態（BookStatus）
+
+    Returns:
+        dict: {
+            'category1': {第１分類: 件数},
+            'category2': {第１分類: {第２分類: 件数}},
+            'status': {BookStatusの名前: 件数},
+        }
+    """
+    rows = query.with_entities(
+        Book.category1,
+        Book.category2,
+        Book.status,
+        func.count(Book.id)
+    ).group_by(
+        Book.category1, Book.category2, Book.status
+    ).order_by(None).all()
+
+    facets = {
+        'category1': {},
+        'category2': {},
+        'status': {s.name: 0 for s in BookStatus},
+    }
+    for cat1, cat2, book_status, count in rows:
+        status_matches = status is None or book_status == status
+        category1_matches = not category1 or cat1 == category1
+        category2_matches = not category2 or cat2 == category2
+
+        if status_matches:
+            if cat1:
+                facets['category1'][cat1] = facets['category1'].get(cat1, 0) + count
+                if cat2:
+                    by_category2 = facets['category2'].setdefault(cat1, {})
+                    by_category2[cat2] = by_category2.get(cat2, 0) + count
+
+        if category1_matches and category2_matches and book_status is not None:
+            facets['status'][book_status.name] += count
+
+    return facets
@@ -0,0 +1,214 @@
+"""
+時間のかかる処理（CSVインポートなど）をバックグラウンドで実行するジョブ管理サービス
+
+アップロードを受け付けたリクエストは jobs テーブルにジョブを登録してすぐに応答し、
+ワーカー（`flask run-jobs` または Webプロセス内のスレッド）がジョブを取り出して実行する。
+進捗は処理中のトランザクションとは別の接続で jobs テーブルに記録し、画面からポーリングで確認する。
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, update
+
+from models import db, Job, JobStatus
+from utils.encoding import detect_encoding
+
+logger = logging.getLogger(__name__)
+
+# 進捗の記録が途絶えてからこの秒数を過ぎた処理中のジョブは、ワーカーが停止したものとして再実行する
+STALE_JOB_SECONDS = 600
+
+# 画面に表示・保存するエラーメッセージの最大件数
+MAX_STORED_ERRORS = 100
+
+
+def _handlers():
+    from services.book_service import import_books_from_csv
+    from services.user_service import import_users_from_csv
+
+    def import_books(job, progress):
+        return import_books_from_csv(job.file_path, job.user_id, ip_address=job.ip_address, progress=progress)
+
+    def import_users(job, progress):
+        return import_users_from_csv(job.file_path, progress=progress)
+
+    return {
+        'import_books': import_books,
+        'import_users': import_users,
+    }
+
+
+def enqueue_job(kind, user_id, file_path=None, filename=None, ip_address=None):
+    """
+    ジョブを登録する
+
+    Args:
+        kind: 処理の種類（import_books, import_users）
+        user_id: 依頼したユーザーのID
+        file_path: 処理するファイルのパス
+        filename: 元のファイル名（表示用）
+        ip_address: 操作ログに記録するIPアドレス
+
+    Returns:
+        Job: 登録したジョブ
+    """
+    if file_path:
+        # 別のディレクトリで起動したワーカーからも参照できるよう絶対パスで記録する
+        file_path = os.path.abspath(file_path)
+    job = Job(kind=kind, user_id=user_id, file_path=file_path, filename=filename, ip_address=ip_address)
+    db.session.add(job)
+    db.session.commit()
+    worker.wake()
+    logger.info(f"Queued job {job.id} ({kind})")
+    return job
+
+
+def _update_job(job_id, **values):
+    """ジョブの状態を、実行中の処理のトランザクションとは別の接続で記録する"""
+    with db.engine.begin() as connection:
+        connection.execute(update(Job).where(Job.id == job_id).values(**values))
+
+
+def _count_rows(file_path):
+    """CSVのデータ行数を数える（ヘッダー行を除く）"""
+    with open(file_path, 'r', encoding=detect_encoding(file_path), newline='') as csvfile:
+        return max(0, sum(1 for _ in csv.reader(csvfile)) - 1)
+
+
+def _claim_next_job():
+    """実行待ちのジョブを1件取り出して処理中にする（他のワーカーと重複しない）"""
+    now = datetime.utcnow()
+    job = Job.query.filter(
+        or_(
+            Job.status == JobStatus.QUEUED,
+            (Job.status == JobStatus.RUNNING) & (Job.heartbeat_at < now - timedelta(seconds=STALE_JOB_SECONDS))
+        )
+    ).order_by(Job.id).with_for_update(skip_locked=True).first()
+    if job is None:
+        db.session.rollback()
+        return None
+    if job.status == JobStatus.RUNNING:
+        logger.warning(f"Restarting stale job {job.id}")
+    job.status = JobStatus.RUNNING
+    job.started_at = now
+    job.heartbeat_at = now
+    job.processed = 0
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """ジョブを実行し、結果を jobs テーブルに記録する"""
+    handler = _handlers().get(job.kind)
+    job_id, file_path = job.id, job.file_path
+    try:
+        if handler is None:
+            raise ValueError(f'不明なジョブの種類です: {job.kind}')
+        if file_path:
+            _update_job(job_id, total=_count_rows(file_path))
+
+        def progress(processed):
+            # 進捗の記録に失敗しても処理は続ける
+            try:
+                _update_job(job_id, processed=processed, heartbeat_at=datetime.utcnow())
+            except Exception as e:
+                logger.warning(f"Failed to record progress of job {job_id}: {e}")
+
+        success_count, error_count, errors = handler(job, progress)
+        _update_job(
+            job_id,
+            status=JobStatus.COMPLETED,
+            success_count=success_count,
+            error_count=error_count,
+            errors=json.dumps(errors[:MAX_STORED_ERRORS], ensure_ascii=False),
+            message=f'{success_count}件を登録しました。' if not error_count
+            else f'{error_count}件のエラーがあったため、登録しませんでした。' if not success_count
+            else f'{success_count}件を登録し、{error_count}件は失敗しました。',
+            finished_at=datetime.utcnow()
+        )
+        logger.info(f"Job {job_id} completed: {success_count} succeeded, {error_count} failed")
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+        _update_job(
+            job_id,
+            status=JobStatus.FAILED,
+            message=f'処理中に予期せぬエラーが発生しました: {str(e)}'[:500],
+            finished_at=datetime.utcnow()
+        )
+    finally:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def run_pending_jobs():
+    """
+    実行待ちのジョブを全て実行する
+
+    Returns:
+        int: 実行したジョブの数
+    """
+    count = 0
+    while True:
+        job = _claim_next_job()
+        if job is None:
+            return count
+        run_job(job)
+        db.session.remove()
+        count += 1
+
+
+class JobWorker:
+    """ジョブを実行するバックグラウンドスレッド（Webプロセス内で実行する場合）"""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(app,), name='job-worker', daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """ジョブが登録されたときに待機を打ち切る"""
+        self._wake.set()
+
+    def _run(self, app):
+        interval = app.config.get('JOB_POLL_INTERVAL', 5)
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    run_pending_jobs()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Job worker error: {e}")
+                finally:
+                    db.session.remove()
+
+
+worker = JobWorker()
+
+
+def run_worker(app, poll_interval=None):
+    """ジョブを実行し続ける（`flask run-jobs` 用のワーカープロセス）"""
+    interval = poll_interval or app.config.get('JOB_POLL_INTERVAL', 5)
+    logger.info("Job worker started")
+    while True:
+        if run_pending_jobs() == 0:
+            time.sleep(interval)
+
+
+def init_job_worker(app):
+    """設定が有効な場合、アプリケーションのプロセス内でジョブのワーカーを起動する"""
+    if app.config.get('JOB_WORKER_ENABLED') and not app.testing:
+        worker.start(app)
@@ -3,14 +3,78 @@
 """
 
 from datetime import datetime, timedelta
-from models import db, Book, User, LoanHistory, Reservation, ReservationStatus
+from sqlalchemy import insert, or_, update
+from models import (db, Book, User, LoanHistory, Reservation, ReservationStatus, BookStatus, OperationLog,
+                    overdue_loan_exists, refresh_user_counters, renumber_reservation_queue)
+from services.outbox_service import enqueue_slack_dm, enqueue_slack_dms
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class BorrowEligibility:
+    """ユーザーの貸出可否の判定結果"""
+    
+    def __init__(self, user_id, max_loan_limit, active_loans, pending_reservations, has_overdue):
+        self.user_id = user_id
+        self.max_loan_limit = max_loan_limit
+        self.active_loans = active_loans
+        self.pending_reservations = pending_reservations
+        self.has_overdue = bool(has_overdue)  # 延滞中の本があるか
+    
+    @property
+    def total_active(self):
+        """貸出中 + 予約中の冊数"""
+        return self.active_loans + self.pending_reservations
+    
+    @property
+    def remaining(self):
+        """追加で借りられる（予約できる）冊数"""
+        return max(self.max_loan_limit - self.total_active, 0)
+    
+    @property
+    def can_borrow(self):
+        """新しく借りる（予約する）ことができるか"""
+        return not self.has_overdue and self.total_active < self.max_loan_limit
+    
+    @property
+    def error_message(self):
+        """借りられない理由（借りられる場合は空文字）"""
+        if self.has_overdue:
+            return "延滞中の本があるため、新しい本を借りることができません。まず延滞本を返却してください。"
+        if self.total_active >= self.max_loan_limit:
+            return f"貸出上限({self.max_loan_limit}冊)に達しています。現在: 貸出中{self.active_loans}冊 + 予約中{self.pending_reservations}冊 = {self.total_active}冊"
+        return ""
+
+
 class LoanService:
     """貸出サービスクラス"""
     
+    @staticmethod
+    def get_borrow_eligibility(user_id):
+        """
+        貸出中・延滞中・予約中の件数を取得する
+        
+        貸出中・予約中の件数は users テーブルのカウンター列（貸出・予約の変更と同じ
+        トランザクションで更新される）から主キーで読む。延滞は時間の経過で発生するため、
+        同じクエリ内で貸出履歴のインデックスを使った EXISTS で判定する。
+        
+        Args:
+            user_id: ユーザーID
+            
+        Returns:
+            BorrowEligibility: 判定結果（ユーザーが存在しない場合はNone）
+        """
+        row = db.session.query(
+            User.max_loan_limit,
+            User.active_loans,
+            User.pending_reservations,
+            overdue_loan_exists(User.id)
+        ).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        return BorrowEligibility(user_id, *row)
+    
     @staticmethod
     def can_user_borrow_book(user_id, book_id=None):
         """
@@ -23,18 +87,13 @@ class LoanService:
         Returns:
             tuple: (可否(bool), エラーメッセージ(str))
         """
-        user = User.query.get(user_id)
-        if not user:
+        eligibility = LoanService.get_borrow_eligibility(user_id)
+        if eligibility is None:
             return False, "ユーザーが見つかりません"
         
-        # 延滞中の本があるかチェック
-        if user.has_overdue_books():
-            return False, "延滞中の本があるため、新しい本を借りることができません。まず延滞本を返却してください。"
-        
-        # 貸出上限チェック
-        if not user.can_borrow_more():
-            current_total = user.current_loan_count() + user.current_reservation_count()
-            return False, f"貸出上限({user.max_loan_limit}冊)に達しています。現在: 貸出中{user.current_loan_count()}冊 + 予約中{user.current_reservation_count()}冊 = {current_total}冊"
+        # 延滞・貸出上限チェック
+        if not eligibility.can_borrow:
+            return False, eligibility.error_message
         
         # 特定の本が指定されている場合、その本の状態をチェック
         if book_id:
@@ -42,19 +101,33 @@ class LoanService:
             if not book:
                 return False, "指定された本が見つかりません"
             
-            if not book.is_available:
-                return False, "この本は現在貸出不可となっています"
-            
-            if book.borrower_id:
-                return False, "この本は既に他のユーザーに貸し出されています"
+            error_msg = LoanService._book_unavailable_reason(book)
+            if error_msg:
+                return False, error_msg
         
         return True, ""
     
+    @staticmethod
+    def _book_unavailable_reason(book):
+        """本が貸出できない理由（貸出できる場合は空文字）"""
+        if not book.is_available:
+            return "この本は現在貸出不可となっています"
+        
+        if book.borrower_id:
+            return "この本は既に他のユーザーに貸し出されています"
+        
+        return ""
+    
     @staticmethod
     def borrow_book(user_id, book_id, due_date=None):
         """
         本を貸し出す
         
+        ユーザー行と書籍行を SELECT ... FOR UPDATE でロックしてから貸出可否を確認する。
+        複数のワーカーで同じ本（または同じユーザー）の貸出が同時に実行されても、
+        後から来た処理はロックの解放を待ってから最新の状態で判定するため、
+        二重貸出や貸出上限の超過は起きない。
+        
         Args:
             user_id: ユーザーID
             book_id: 本のID
@@ -63,22 +136,35 @@ class LoanService:
         Returns:
             tuple: (成功(bool), メッセージ(str), 貸出履歴ID(int|None))
         """
-        # 貸出可能性チェック
-        can_borrow, error_msg = LoanService.can_user_borrow_book(user_id, book_id)
-        if not can_borrow:
-            return False, error_msg, None
-        
-        user = User.query.get(user_id)
-        book = Book.query.get(book_id)
-        
         # 返却期限の設定（デフォルト2週間）
         if due_date is None:
             due_date = datetime.utcnow() + timedelta(weeks=2)
         
         try:
+            # ロックはユーザー → 書籍の順に取得する（デッドロック防止）
+            user = User.query.filter_by(id=user_id).populate_existing().with_for_update().first()
+            if not user:
+                db.session.rollback()
+                return False, "ユーザーが見つかりません", None
+            
+            book = Book.query.filter_by(id=book_id).populate_existing().with_for_update().first()
+            if not book:
+                db.session.rollback()
+                return False, "指定された本が見つかりません", None
+            
+            # ロックした行の値で貸出可能性をチェック
+            eligibility = BorrowEligibility(
+                user.id, user.max_loan_limit, user.active_loans,
+                user.pending_reservations, db.session.query(overdue_loan_exists(user.id)).scalar()
+            )
+            error_msg = eligibility.error_message or LoanService._book_unavailable_reason(book)
+            if error_msg:
+                db.session.rollback()
+                return False, error_msg, None
+            
             # 本の状態を更新
             book.borrower_id = user_id
-            book.status = 'ON_LOAN'
+            book.status = BookStatus.ON_LOAN
             
             # 貸出履歴を作成
             loan_history = LoanHistory(
@@ -95,7 +181,7 @@ class LoanService:
             pending_reservations = Reservation.query.filter_by(
                 book_id=book_id,
                 status=ReservationStatus.PENDING
-            ).order_by(Reservation.reservation_date).all()
+            ).order_by(Reservation.queue_rank).all()
             
             if pending_reservations:
                 # 最初の予約が自分の予約の場合、それを満たす
@@ -104,6 +190,23 @@ class LoanService:
                     first_reservation.status = ReservationStatus.FULFILLED
                     logger.info(f"予約が満たされました - Book: {book.title}, User: {user.email}")
             
+            # 返却されて取り置き中（通知済み）の自分の予約も満たす
+            for reservation in Reservation.query.filter_by(
+                book_id=book_id,
+                user_id=user_id,
+                status=ReservationStatus.NOTIFIED
+            ):
+                reservation.status = ReservationStatus.FULFILLED
+            
+            # 貸し出した本人への通知（貸出と同じトランザクションで登録する）
+            book_url = f"http://localhost/books/book/{book_id}"
+            enqueue_slack_dm(user, (
+                f"図書管理アプリです！以下の本の貸出がされました。\n"
+                f"書籍：<{book_url}|{book.title}>\n"
+                f"返却期限：{due_date.strftime('%Y-%m-%d')}\n\n"
+                f"返却期限を守り、書籍は元の場所へ返却するようお願いいたします。"
+            ))
+            
             db.session.commit()
             
             logger.info(f"本が貸し出されました - Book: {book.title}, User: {user.email}, Due: {due_date}")
@@ -144,7 +247,7 @@ class LoanService:
             pending_reservations = Reservation.query.filter_by(
                 book_id=book.id,
                 status=ReservationStatus.PENDING
-            ).order_by(Reservation.reservation_date).all()
+            ).order_by(Reservation.queue_rank).all()
             
             if pending_reservations:
                 # 最初の予約者に通知
@@ -202,6 +305,15 @@ class LoanService:
             loan_history.extension_count += 1
             loan_history.extended_date = datetime.utcnow()
             
+            # 借りている本人への通知（延長と同じトランザクションで登録する）
+            book_url = f"http://localhost/books/book/{loan_history.book_id}"
+            enqueue_slack_dm(loan_history.borrower, (
+                f"図書管理アプリです！貸出期間が延長されました。\n"
+                f"書籍：<{book_url}|{loan_history.book.title}>\n"
+                f"新しい返却期限：{loan_history.due_date.strftime('%Y-%m-%d')}\n\n"
+                f"返却期限を守り、返却の際、本は自分で戻してください。"
+            ))
+            
             db.session.commit()
             
             logger.info(f"貸出期間が延長されました - Book: {loan_history.book.title}, User: {loan_history.borrower.email}, New due: {loan_history.due_date}")
@@ -212,6 +324,276 @@ class LoanService:
             logger.error(f"延長処理でエラーが発生しました: {e}")
             return False, "延長処理中にエラーが発生しました"
     
+    @staticmethod
+    def bulk_return_books(book_numbers, ip_address=None):
+        """
+        複数の本をまとめて返却する（カウンターでの一括返却用）
+        
+        書籍・貸出・次の予約者の取得と更新をそれぞれ1回の集合演算で行い、
+        通知のアウトボックスへの登録も含めて全件を1トランザクションでコミットする。
+        
+        Args:
+            book_numbers: 管理番号のリスト
+            ip_address: 操作ログに記録するIPアドレス
+            
+        Returns:
+            dict: {'returned': [管理番号], 'errors': [{'book_number', 'error'}]}
+        """
+        now = datetime.utcnow()
+        book_numbers = list(dict.fromkeys(book_numbers))
+        result = {'returned': [], 'errors': []}
+        notifications = []
+        
+        books = Book.query.filter(
+            Book.book_number.in_(book_numbers)
+        ).order_by(Book.id).populate_existing().with_for_update().all()
+        books_by_number = {book.book_number: book for book in books}
+        
+        loans = LoanHistory.query.filter(
+            LoanHistory.book_id.in_([book.id for book in books]),
+            LoanHistory.return_date.is_(None)
+        ).all()
+        loans_by_book = {loan.book_id: loan for loan in loans}
+        
+        returned = []
+        for number in book_numbers:
+            book = books_by_number.get(number)
+            if not book:
+                result['errors'].append({'book_number': number, 'error': '指定された本が見つかりません'})
+            elif book.id not in loans_by_book:
+                result['errors'].append({'book_number': number, 'error': 'この本は既に返却されています'})
+            else:
+                returned.append((book, loans_by_book[book.id]))
+        
+        if not returned:
+            db.session.rollback()
+            return result
+        
+        book_ids = [book.id for book, _ in returned]
+        
+        # 各書籍の次の予約者（予約順位1位）
+        next_reservations = {
+            reservation.book_id: reservation
+            for reservation in Reservation.query.filter(
+                Reservation.book_id.in_(book_ids),
+                Reservation.status == ReservationStatus.PENDING,
+                Reservation.queue_rank == 1
+            )
+        }
+        reserved_ids = list(next_reservations)
+        available_ids = [book_id for book_id in book_ids if book_id not in next_reservations]
+        
+        # 通知の内容
+        for book, loan in returned:
+            result['returned'].append(book.book_number)
+            book_url = f"http://localhost/books/book/{book.id}"
+            notifications.append((loan.borrower_id, (
+                f"図書管理アプリです！以下の本が返却されました。\n"
+                f"書籍：<{book_url}|{book.title}>\n\n"
+                f"ご利用ありがとうございました。"
+            )))
+            reservation = next_reservations.get(book.id)
+            if reservation:
+                notifications.append((reservation.user_id, (
+                    f"図書管理アプリです！ご予約の本がご用意できました。\n"
+                    f"書籍：<{book_url}|{book.title}>\n"
+                    f"貸出期限：{(now + timedelta(days=7)).strftime('%Y-%m-%d')}\n\n"
+                    f"期限までに貸出手続きをお願いいたします。"
+                )))
+        affected_user_ids = {loan.borrower_id for _, loan in returned} | {r.user_id for r in next_reservations.values()}
+        
+        db.session.execute(
+            update(LoanHistory).where(
+                LoanHistory.id.in_([loan.id for _, loan in returned])
+            ).values(return_date=now),
+            execution_options={'synchronize_session': False}
+        )
+        if available_ids:
+            db.session.execute(
+                update(Book).where(Book.id.in_(available_ids)).values(
+                    borrower_id=None, status=BookStatus.AVAILABLE
+                ),
+                execution_options={'synchronize_session': False}
+            )
+        if reserved_ids:
+            db.session.execute(
+                update(Book).where(Book.id.in_(reserved_ids)).values(
+                    borrower_id=None, status=BookStatus.RESERVED
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.execute(
+                update(Reservation).where(
+                    Reservation.id.in_([r.id for r in next_reservations.values()])
+                ).values(
+                    status=ReservationStatus.NOTIFIED,
+                    notification_sent=True,
+                    notification_sent_at=now
+                ),
+                execution_options={'synchronize_session': False}
+            )
+        db.session.execute(insert(OperationLog), [
+            {
+                'user_id': loan.borrower_id,
+                'action': 'bulk_return_book',
+                'target': f'Book {book.id}',
+                'timestamp': now,
+                'ip_address': ip_address,
+            }
+            for book, loan in returned
+        ])
+        
+        # 集合演算での更新はセッションのイベントを通らないため、件数と予約順位を明示的に更新する
+        connection = db.session.connection()
+        refresh_user_counters(connection, affected_user_ids, now)
+        for book_id in reserved_ids:
+            renumber_reservation_queue(connection, book_id)
+        enqueue_slack_dms(notifications)
+        db.session.commit()
+        
+        logger.info(f"一括返却しました - {len(returned)}冊")
+        return result
+    
+    @staticmethod
+    def bulk_borrow_books(user_id, book_numbers, due_date=None, ip_address=None):
+        """
+        複数の本をまとめて1人のユーザーに貸し出す（カウンターでの一括貸出用）
+        
+        borrow_book と同じくユーザー行・書籍行をロックしてから判定し、
+        貸出上限に収まる分だけを1トランザクションで貸し出す。
+        自分が予約順位1位の予約と、取り置き中（通知済み）の予約は貸出完了にする。
+        
+        Args:
+            user_id: 借りるユーザーのID
+            book_numbers: 管理番号のリスト
+            due_date: 返却期限日（指定なしの場合は2週間後）
+            ip_address: 操作ログに記録するIPアドレス
+            
+        Returns:
+            dict: {'borrowed': [管理番号], 'errors': [{'book_number', 'error'}]}
+        """
+        now = datetime.utcnow()
+        if due_date is None:
+            due_date = now + timedelta(weeks=2)
+        book_numbers = list(dict.fromkeys(book_numbers))
+        result = {'borrowed': [], 'errors': []}
+        notifications = []
+        
+        # ロックはユーザー → 書籍の順に取得する（borrow_book と同じ順序）
+        user = User.query.filter_by(id=user_id).populate_existing().with_for_update().first()
+        if not user:
+            db.session.rollback()
+            result['errors'] = [{'book_number': n, 'error': 'ユーザーが見つかりません'} for n in book_numbers]
+            return result
+        
+        eligibility = BorrowEligibility(
+            user.id, user.max_loan_limit, user.active_loans,
+            user.pending_reservations, db.session.query(overdue_loan_exists(user.id)).scalar()
+        )
+        if eligibility.has_overdue:
+            db.session.rollback()
+            result['errors'] = [{'book_number': n, 'error': eligibility.error_message} for n in book_numbers]
+            return result
+        
+        books = Book.query.filter(
+            Book.book_number.in_(book_numbers)
+        ).order_by(Book.id).populate_existing().with_for_update().all()
+        books_by_number = {book.book_number: book for book in books}
+        
+        # このユーザーが予約順位1位の予約と、返却されて取り置き中（通知済み）の予約
+        own_reservations = {
+            reservation.book_id: reservation
+            for reservation in Reservation.query.filter(
+                Reservation.book_id.in_([book.id for book in books]),
+                Reservation.user_id == user_id,
+                or_(
+                    (Reservation.status == ReservationStatus.PENDING) & (Reservation.queue_rank == 1),
+                    Reservation.status == ReservationStatus.NOTIFIED
+                )
+            )
+        }
+        
+        total_active = eligibility.total_active
+        borrowed = []
+        for number in book_numbers:
+            book = books_by_number.get(number)
+            error_msg = LoanService._book_unavailable_reason(book) if book else '指定された本が見つかりません'
+            # 予約待ちの予約は予約数として数えているため、貸出に置き換わるだけで合計は増えない
+            reservation = own_reservations.get(book.id) if book else None
+            fulfils_reservation = reservation is not None and reservation.status == ReservationStatus.PENDING
+            if not error_msg and not fulfils_reservation and total_active >= user.max_loan_limit:
+                error_msg = f"貸出上限({user.max_loan_limit}冊)に達しています"
+            if error_msg:
+                result['errors'].append({'book_number': number, 'error': error_msg})
+                continue
+            borrowed.append(book)
+            if not fulfils_reservation:
+                total_active += 1
+        
+        if not borrowed:
+            db.session.rollback()
+            return result
+        
+        # 通知の内容
+        result['borrowed'] = [book.book_number for book in borrowed]
+        titles = '\n'.join(
+            f"・<http://localhost/books/book/{book.id}|{book.title}>" for book in borrowed
+        )
+        notifications.append((user_id, (
+            f"図書管理アプリです！以下の本の貸出がされました。\n"
+            f"{titles}\n"
+            f"返却期限：{due_date.strftime('%Y-%m-%d')}\n\n"
+            f"返却期限を守り、書籍は元の場所へ返却するようお願いいたします。"
+        )))
+        user_email = user.email
+        
+        book_ids = [book.id for book in borrowed]
+        db.session.execute(
+            update(Book).where(Book.id.in_(book_ids)).values(
+                borrower_id=user_id, status=BookStatus.ON_LOAN
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.execute(insert(LoanHistory), [
+            {
+                'book_id': book.id,
+                'book_title': book.title,
+                'borrower_id': user_id,
+                'loan_date': now,
+                'due_date': due_date,
+            }
+            for book in borrowed
+        ])
+        fulfilled = [own_reservations[book_id] for book_id in book_ids if book_id in own_reservations]
+        if fulfilled:
+            db.session.execute(
+                update(Reservation).where(
+                    Reservation.id.in_([r.id for r in fulfilled])
+                ).values(status=ReservationStatus.FULFILLED),
+                execution_options={'synchronize_session': False}
+            )
+        db.session.execute(insert(OperationLog), [
+            {
+                'user_id': user_id,
+                'action': 'bulk_borrow_book',
+                'target': f'Book {book.id}',
+                'timestamp': now,
+                'ip_address': ip_address,
+            }
+            for book in borrowed
+        ])
+        
+        # 集合演算での更新はセッションのイベントを通らないため、件数と予約順位を明示的に更新する
+        connection = db.session.connection()
+        refresh_user_counters(connection, [user_id], now)
+        for book_id in {r.book_id for r in fulfilled}:
+            renumber_reservation_queue(connection, book_id)
+        enqueue_slack_dms(notifications)
+        db.session.commit()
+        
+        logger.info(f"一括貸出しました - User: {user_email}, {len(borrowed)}冊")
+        return result
+    
     @staticmethod
     def get_user_active_loans(user_id):
         """
@@ -0,0 +1,202 @@
+"""
+通知の送信待ちキュー（アウトボックス）を管理するサービス
+
+業務処理と同じトランザクションで notification_outbox に通知を登録し、
+バックグラウンドのディスパッチャーがSlackへ送信する。
+リクエストの処理時間に外部APIの応答時間が含まれないようにするための仕組み。
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from models import db, NotificationOutbox, NotificationStatus, User
+from services.slack_service import send_slack_dm_to_user
+
+logger = logging.getLogger(__name__)
+
+# 送信に失敗した通知を再試行する回数の上限
+MAX_ATTEMPTS = 5
+
+# 再試行までの待ち時間（秒、失敗するごとに2倍にする）
+RETRY_BASE_SECONDS = 60
+
+# 取得した通知を他のディスパッチャーが取らないようにしておく時間（秒）
+CLAIM_SECONDS = 300
+
+
+def enqueue_slack_dm(user, message):
+    """
+    SlackのDMを送信待ちに登録する（コミットは呼び出し側で行う）
+
+    Args:
+        user: 宛先のユーザー
+        message: メッセージ本文
+    """
+    db.session.add(NotificationOutbox(user_id=user.id, channel='slack_dm', message=message))
+    db.session.info['outbox_enqueued'] = True
+
+
+def enqueue_slack_dms(notifications):
+    """
+    複数のSlackのDMを1回のINSERTで送信待ちに登録する（コミットは呼び出し側で行う）
+
+    Args:
+        notifications: (ユーザーID, メッセージ) のリスト
+    """
+    if not notifications:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert(NotificationOutbox), [
+        {
+            'user_id': user_id,
+            'channel': 'slack_dm',
+            'message': message,
+            'status': NotificationStatus.PENDING,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now,
+        }
+        for user_id, message in notifications
+    ])
+    db.session.info['outbox_enqueued'] = True
+
+
+def _claim_pending(batch_size):
+    """送信期限が来た通知を取得し、他のディスパッチャーと重複しないよう予約する"""
+    now = datetime.utcnow()
+    rows = NotificationOutbox.query.filter(
+        NotificationOutbox.status == NotificationStatus.PENDING,
+        NotificationOutbox.next_attempt_at <= now
+    ).order_by(
+        NotificationOutbox.id
+    ).limit(batch_size).with_for_update(skip_locked=True).all()
+
+    claimed = []
+    for row in rows:
+        row.attempts += 1
+        row.next_attempt_at = now + timedelta(seconds=CLAIM_SECONDS)
+        claimed.append((row.id, row.user_id, row.message, row.attempts))
+    db.session.commit()
+    return claimed
+
+
+def dispatch_pending_notifications(batch_size=50):
+    """
+    送信待ちの通知を送信する
+
+    送信に失敗した通知は待ち時間を倍にしながら MAX_ATTEMPTS 回まで再試行する。
+
+    Returns:
+        int: 処理した件数（失敗して再試行待ちになったものを含む）
+    """
+    claimed = _claim_pending(batch_size)
+    if not claimed:
+        return 0
+
+    users = {user.id: user for user in User.query.filter(User.id.in_({c[1] for c in claimed}))}
+    results = []
+    for outbox_id, user_id, message, attempts in claimed:
+        error = None
+        try:
+            user = users.get(user_id)
+            if user is None:
+                error = 'user not found'
+            elif not send_slack_dm_to_user(user, message):
+                error = 'send failed'
+        except Exception as e:
+            db.session.rollback()
+            error = str(e)[:500]
+        results.append((outbox_id, attempts, error))
+
+    now = datetime.utcnow()
+    sent = 0
+    for outbox_id, attempts, error in results:
+        row = db.session.get(NotificationOutbox, outbox_id)
+        if row is None:
+            continue
+        if error is None:
+            row.status = NotificationStatus.SENT
+            row.sent_at = now
+            row.last_error = None
+            sent += 1
+        elif attempts >= MAX_ATTEMPTS:
+            row.status = NotificationStatus.FAILED
+            row.last_error = error
+            logger.error(f"Giving up notification {outbox_id} after {attempts} attempts: {error}")
+        else:
+            row.next_attempt_at = now + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            row.last_error = error
+    db.session.commit()
+
+    logger.info(f"Dispatched {sent}/{len(results)} notifications")
+    return len(results)
+
+
+class OutboxDispatcher:
+    """アウトボックスを定期的に送信するバックグラウンドスレッド"""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(app,), name='outbox-dispatcher', daemon=True
+        )
+        self._thread.start()
+
+    def wake(self):
+        """新しい通知が登録されたときに待機を打ち切る"""
+        self._wake.set()
+
+    def _run(self, app):
+        interval = app.config.get('OUTBOX_POLL_INTERVAL', 5)
+        batch_size = app.config.get('OUTBOX_BATCH_SIZE', 50)
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    while dispatch_pending_notifications(batch_size) >= batch_size:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Outbox dispatcher error: {e}")
+                finally:
+                    db.session.remove()
+
+
+dispatcher = OutboxDispatcher()
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_dispatcher(session):
+    """通知が登録されたトランザクションのコミット後にディスパッチャーを起こす"""
+    if session.info.pop('outbox_enqueued', False):
+        dispatcher.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_enqueued_flag(session):
+    session.info.pop('outbox_enqueued', None)
+
+
+def init_outbox_dispatcher(app):
+    """
+    設定が有効な場合、リクエストを処理するプロセス内でディスパッチャーを起動する
+
+    `flask db upgrade` やスケジューラーなど、アプリを作成するだけのプロセスでは起動しないよう、
+    最初のリクエストを受けたときに起動する。
+    """
+    if not app.config.get('OUTBOX_DISPATCHER_ENABLED') or app.testing:
+        return
+
+    @app.before_request
+    def start_outbox_dispatcher():
+        dispatcher.start(app)
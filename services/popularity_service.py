@@ -0,0 +1,74 @@
+"""
+人気の本のランキングを集計するサービス
+
+貸出履歴の集計は定期実行タスク（scheduler.py）と `flask refresh-popular-books` で行い、
+ダッシュボードは集計済みの book_popularity テーブルを読むだけにする。
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, insert
+
+from models import db, BookPopularity, LoanHistory
+
+logger = logging.getLogger(__name__)
+
+
+def popularity_score(loan_dates, now, half_life_days):
+    """
+    貸出日時のリストから時間減衰付きの人気スコアを計算する
+
+    1回の貸出は half_life_days 日ごとに重みが半分になる。
+    half_life_days が0以下の場合は減衰させず、貸出回数をそのままスコアとする。
+    """
+    if half_life_days <= 0:
+        return float(len(loan_dates))
+    return sum(
+        0.5 ** (max((now - loan_date).total_seconds(), 0) / 86400 / half_life_days)
+        for loan_date in loan_dates
+    )
+
+
+def refresh_book_popularity(now=None):
+    """
+    集計期間内の貸出履歴から人気ランキングを作り直す
+
+    Returns:
+        int: ランキングに登録した書籍数
+    """
+    now = now or datetime.utcnow()
+    window_days = current_app.config.get('POPULAR_BOOKS_WINDOW_DAYS', 30)
+    half_life_days = current_app.config.get('POPULAR_BOOKS_HALF_LIFE_DAYS', 7)
+    since = now - timedelta(days=window_days)
+
+    loan_dates = {}
+    rows = db.session.query(LoanHistory.book_id, LoanHistory.loan_date).filter(
+        LoanHistory.loan_date >= since
+    )
+    for book_id, loan_date in rows:
+        loan_dates.setdefault(book_id, []).append(loan_date)
+
+    ranking = sorted(
+        ((popularity_score(dates, now, half_life_days), len(dates), book_id)
+         for book_id, dates in loan_dates.items()),
+        key=lambda item: (-item[0], -item[1], item[2])
+    )
+
+    db.session.execute(delete(BookPopularity))
+    if ranking:
+        db.session.execute(insert(BookPopularity), [
+            {
+                'book_id': book_id,
+                'rank': rank,
+                'score': score,
+                'loan_count': loan_count,
+                'refreshed_at': now,
+            }
+            for rank, (score, loan_count, book_id) in enumerate(ranking, start=1)
+        ])
+    db.session.commit()
+
+    logger.info(f"Refreshed popularity ranking for {len(ranking)} books")
+    return len(ranking)
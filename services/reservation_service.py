@@ -2,8 +2,8 @@ from datetime import datetime
 from flask import current_app
 from sqlalchemy import and_, or_
 
-from models import db, Book, User, Reservation, LoanHistory
-from services.email_service import send_reservation_notification, send_due_date_reminder
+from models import db, Book, User, Reservation, LoanHistory, ReservationStatus
+from services.email_service import send_reservation_notification, send_due_date_reminders
 
 def get_reservations(user_id=None, book_id=None, status=None):
     """予約一覧を取得する（フィルタ条件付き）"""
@@ -26,7 +26,7 @@ def get_active_reservations_for_book(book_id):
     return Reservation.query.filter(
         and_(
             Reservation.book_id == book_id,
-            Reservation.status.in_(['pending', 'notified'])
+            Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.NOTIFIED])
         )
     ).order_by(Reservation.reservation_date).all()
 
@@ -41,7 +41,7 @@ def create_reservation(book_id, user_id):
         and_(
             Reservation.book_id == book_id,
             Reservation.user_id == user_id,
-            Reservation.status.in_(['pending', 'notified'])
+            Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.NOTIFIED])
         )
     ).first()
 
@@ -62,7 +62,7 @@ def create_reservation(book_id, user_id):
     reservation = Reservation(
         book_id=book_id,
         user_id=user_id,
-        status='pending'
+        status=ReservationStatus.PENDING
     )
 
     db.session.add(reservation)
@@ -83,7 +83,7 @@ def cancel_reservation(reservation_id, user_id=None):
         if not user or not user.is_admin:
             raise ValueError('この予約をキャンセルする権限がありません')
 
-    reservation.status = 'cancelled'
+    reservation.status = ReservationStatus.CANCELLED
     db.session.commit()
 
     current_app.logger.info(f'予約キャンセル: Reservation {reservation_id}')
@@ -95,9 +95,9 @@ def process_book_return(book_id):
     oldest_reservation = Reservation.query.filter(
         and_(
             Reservation.book_id == book_id,
-            Reservation.status == 'pending'
+            Reservation.status == ReservationStatus.PENDING
         )
-    ).order_by(Reservation.reservation_date).first()
+    ).order_by(Reservation.queue_rank).first()
 
     if not oldest_reservation:
         return None
@@ -106,7 +106,7 @@ def process_book_return(book_id):
     user = User.query.get(oldest_reservation.user_id)
 
     # 予約状態を更新
-    oldest_reservation.status = 'notified'
+    oldest_reservation.status = ReservationStatus.NOTIFIED
     oldest_reservation.notification_sent = True
     db.session.commit()
 
@@ -128,20 +128,17 @@ def check_due_date_reminders():
         )
     ).all()
 
-    reminder_count = 0
+    # 残り3日以内かつリマインダー未送信の貸出のメールをまとめて送信
+    targets = []
     for loan in loans:
         days_left = loan.days_until_due()
-        # 残り3日以内かつリマインダー未送信の場合
         if days_left is not None and days_left <= 3 and not loan.reminder_sent:
-            user = loan.borrower
-            book = loan.book
+            targets.append(loan)
 
-            # メール送信
-            if user and user.email:
-                success = send_due_date_reminder(loan)
-                if success:
-                    loan.reminder_sent = True
-                    reminder_count += 1
+    sent_loans = send_due_date_reminders(targets)
+    for loan in sent_loans:
+        loan.reminder_sent = True
+    reminder_count = len(sent_loans)
 
     # 変更を保存
     if reminder_count > 0:
@@ -155,7 +152,7 @@ def get_user_reservation_count(user_id):
     return Reservation.query.filter(
         and_(
             Reservation.user_id == user_id,
-            Reservation.status.in_(['pending', 'notified'])
+            Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.NOTIFIED])
         )
     ).count()
 
@@ -164,10 +161,10 @@ def get_next_in_reservation_queue(book_id):
     next_reservation = Reservation.query.filter(
         and_(
             Reservation.book_id == book_id,
-            Reservation.status == 'pending'
+            Reservation.status == ReservationStatus.PENDING
         )
-    ).order_by(Reservation.reservation_date).first()
+    ).order_by(Reservation.queue_rank).first()
 
     if next_reservation:
         return next_reservation.user
-    return None
\ No newline at end of file
+    return None
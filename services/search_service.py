@@ -0,0 +1,308 @@
+"""
+書籍の全文検索を管理するサービス
+
+- 絞り込み: MySQLでは books.search_text の FULLTEXT (ngram parser) インデックス、
+  それ以外のDB（SQLiteでのテストなど）では book_search_terms のポスティングリストを使う
+- ランキング: book_search_terms を使い、フィールド重み付きのBM25でスコアを計算する
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import case, delete, distinct, event, func, insert, inspect, literal, text
+
+from models import db, Book, BookSearchTerm
+from utils.tokenizer import NGRAM_SIZES, normalize, query_terms, split_segments, tokenize
+
+logger = logging.getLogger(__name__)
+
+# MySQLの ngram_token_size（デフォルト2）に合わせる
+NGRAM_SIZE = 2
+
+# フィールドごとの重み（タイトルの一致を最も重視する）
+FIELD_WEIGHTS = {
+    'title': 3.0,
+    'author': 2.0,
+    'keywords': 1.5,
+    'category': 1.0,
+}
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 書籍数・平均フィールド長のキャッシュ秒数
+STATS_TTL_SECONDS = 300
+
+_INDEXED_ATTRIBUTES = ('title', 'author', 'keywords', 'category1', 'category2')
+
+
+def _posting_terms(text):
+    """
+    ポスティングリストで照合するトークン
+
+    n-gramより短い語（「猫」「C」など）は単独の1文字の語としてしか索引されず、
+    長い語の中の出現はn-gramにしか含まれないため、ポスティングリストでは照合しない
+    （絞り込みは search_text の部分一致で行う）。
+    """
+    return [term for term in query_terms(text) if len(term) >= min(NGRAM_SIZES)]
+
+
+def _split_keyword(keyword):
+    """検索キーワードを books.search_text と同じ規則で正規化し、語のリストに分割する"""
+    return [w for w in normalize(keyword).replace('"', ' ').split() if w]
+
+
+def index_fields(title, author, keywords, category1, category2):
+    """インデックス対象のフィールドを作る（build_term_rows に渡す形式）"""
+    return {
+        'title': title,
+        'author': author,
+        'keywords': keywords,
+        'category': ' '.join(filter(None, [category1, category2])),
+    }
+
+
+def _book_fields(book):
+    """インデックス対象のフィールドを取り出す"""
+    return index_fields(book.title, book.author, book.keywords, book.category1, book.category2)
+
+
+def build_term_rows(book_id, fields):
+    """
+    書籍1件分のポスティング行を作成する
+
+    Args:
+        book_id: 書籍ID
+        fields: フィールド名 -> 文字列 の辞書
+
+    Returns:
+        list: book_search_terms に挿入する行（辞書）のリスト
+    """
+    rows = []
+    for field, value in fields.items():
+        if not value:
+            continue
+        counts = Counter(tokenize(value))
+        field_length = sum(len(segment) for segment in split_segments(normalize(value)))
+        rows.extend({
+            'term': term,
+            'book_id': book_id,
+            'field': field,
+            'term_freq': freq,
+            'field_length': field_length,
+        } for term, freq in counts.items())
+    return rows
+
+
+def _index_book(connection, book):
+    connection.execute(delete(BookSearchTerm).where(BookSearchTerm.book_id == book.id))
+    rows = build_term_rows(book.id, _book_fields(book))
+    if rows:
+        connection.execute(insert(BookSearchTerm), rows)
+
+
+@event.listens_for(Book, 'after_insert')
+def _index_inserted_book(mapper, connection, target):
+    """書籍の登録時にポスティングリストを作成する"""
+    _index_book(connection, target)
+
+
+@event.listens_for(Book, 'after_update')
+def _index_updated_book(mapper, connection, target):
+    """検索対象のフィールドが変わった場合のみポスティングリストを作り直す"""
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in _INDEXED_ATTRIBUTES):
+        _index_book(connection, target)
+
+
+@event.listens_for(Book, 'before_delete')
+def _unindex_deleted_book(mapper, connection, target):
+    """書籍の削除時にポスティングリストを削除する"""
+    connection.execute(delete(BookSearchTerm).where(BookSearchTerm.book_id == target.id))
+
+
+def rebuild_search_index(batch_size=500):
+    """
+    全書籍のポスティングリストを作り直す
+
+    Returns:
+        int: インデックスを作成した書籍数
+    """
+    db.session.execute(delete(BookSearchTerm))
+    count = 0
+    batch = []
+    for book in Book.query.order_by(Book.id).yield_per(batch_size):
+        batch.extend(build_term_rows(book.id, _book_fields(book)))
+        count += 1
+        if count % batch_size == 0 and batch:
+            db.session.execute(insert(BookSearchTerm), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(BookSearchTerm), batch)
+    db.session.commit()
+    _stats_cache.clear()
+    logger.info(f"Rebuilt search index for {count} books")
+    return count
+
+
+def _use_fulltext():
+    """FULLTEXTインデックスを利用できるDBかどうか"""
+    return db.engine.dialect.name == 'mysql'
+
+
+def _matching_book_ids(terms):
+    """全てのトークンを含む書籍IDのサブクエリ"""
+    return db.session.query(BookSearchTerm.book_id).filter(
+        BookSearchTerm.term.in_(terms)
+    ).group_by(
+        BookSearchTerm.book_id
+    ).having(
+        func.count(distinct(BookSearchTerm.term)) == len(terms)
+    )
+
+
+def filter_books_by_keyword(query, keyword):
+    """
+    書籍クエリにキーワード検索条件を追加する
+
+    Args:
+        query: Book のクエリ
+        keyword: 検索キーワード（空白区切りでAND検索）
+
+    Returns:
+        Query: 条件を追加したクエリ
+    """
+    words = _split_keyword(keyword)
+    if not words:
+        return query
+
+    if _use_fulltext():
+        # ngramトークンより短い語はFULLTEXTでは引けないためLIKEで絞り込む
+        long_words = [w for w in words if len(w) >= NGRAM_SIZE]
+        if long_words:
+            against = ' '.join(f'+"{w}"' for w in long_words)
+            query = query.filter(
+                text('MATCH (books.search_text) AGAINST (:search_against IN BOOLEAN MODE)')
+            ).params(search_against=against)
+        for word in words:
+            if len(word) < NGRAM_SIZE:
+                query = query.filter(Book.search_text.contains(word, autoescape=True))
+        return query
+
+    for word in words:
+        terms = _posting_terms(word)
+        if terms:
+            query = query.filter(Book.id.in_(_matching_book_ids(terms)))
+        # n-gramの一致だけでは語順を保証できないので部分一致で確認する
+        query = query.filter(Book.search_text.contains(word, autoescape=True))
+    return query
+
+
+class _StatsCache:
+    """BM25用のコーパス統計（書籍数・平均フィールド長）のキャッシュ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = None
+        self._expires_at = 0
+
+    def get(self):
+        with self._lock:
+            if self._value is None or time.monotonic() >= self._expires_at:
+                self._value = self._load()
+                self._expires_at = time.monotonic() + STATS_TTL_SECONDS
+            return self._value
+
+    def clear(self):
+        with self._lock:
+            self._value = None
+
+    @staticmethod
+    def _load():
+        length = func.char_length if db.engine.dialect.name == 'mysql' else func.length
+        row = db.session.query(
+            func.count(Book.id),
+            func.avg(length(func.coalesce(Book.title, ''))),
+            func.avg(length(func.coalesce(Book.author, ''))),
+            func.avg(length(func.coalesce(Book.keywords, ''))),
+            func.avg(length(func.coalesce(Book.category1, '')) + length(func.coalesce(Book.category2, ''))),
+        ).one()
+        total = row[0] or 0
+        averages = dict(zip(('title', 'author', 'keywords', 'category'), row[1:]))
+        return total, {field: float(avg or 0) or 1.0 for field, avg in averages.items()}
+
+
+_stats_cache = _StatsCache()
+
+
+def rank_books(query, keyword, limit=100, offset=0):
+    """
+    キーワードとの関連度（BM25）が高い順に書籍を取得する
+
+    スコア計算と並び替えはDB側で行い、上位 limit 件の書籍だけを読み込む。
+    ランキングは query の結果を並び替えるだけで、書籍を追加・除外しない
+    （ポスティングリストで照合できない短い語だけのクエリではスコアは全て0になる）。
+
+    Args:
+        query: Book のクエリ（filter_books_by_keyword によるキーワード条件と分類などの絞り込み条件を含む）
+        keyword: 検索キーワード
+        limit: 取得する最大件数
+        offset: 読み飛ばす件数（ページ送り用）
+
+    Returns:
+        list: Book のリスト（各書籍に search_score 属性を付与）
+    """
+    terms = _posting_terms(keyword)
+    doc_freqs = []
+    if terms:
+        doc_freqs = db.session.query(
+            BookSearchTerm.term,
+            func.count(distinct(BookSearchTerm.book_id))
+        ).filter(
+            BookSearchTerm.term.in_(terms)
+        ).group_by(
+            BookSearchTerm.term
+        ).all()
+
+    if doc_freqs:
+        total_books, avg_lengths = _stats_cache.get()
+        idf = {
+            term: math.log(1 + (total_books - df + 0.5) / (df + 0.5))
+            for term, df in doc_freqs
+        }
+        idf_expr = case(idf, value=BookSearchTerm.term, else_=0.0)
+        weight_expr = case(FIELD_WEIGHTS, value=BookSearchTerm.field, else_=1.0)
+        avg_length_expr = case(avg_lengths, value=BookSearchTerm.field, else_=1.0)
+        tf = BookSearchTerm.term_freq
+        score = func.sum(
+            idf_expr * weight_expr * tf * (BM25_K1 + 1.0) /
+            (tf + BM25_K1 * (1.0 - BM25_B + BM25_B * BookSearchTerm.field_length / avg_length_expr))
+        )
+        scores = db.session.query(
+            BookSearchTerm.book_id.label('book_id'),
+            score.label('score')
+        ).filter(
+            BookSearchTerm.term.in_([term for term, _ in doc_freqs])
+        ).group_by(
+            BookSearchTerm.book_id
+        ).subquery()
+        book_score = func.coalesce(scores.c.score, 0.0)
+        query = query.outerjoin(scores, Book.id == scores.c.book_id)
+    else:
+        book_score = literal(0.0)
+
+    results = query.add_columns(
+        book_score
+    ).order_by(
+        book_score.desc(), Book.id
+    ).offset(offset).limit(limit).all()
+
+    books = []
+    for book, value in results:
+        book.search_score = value
+        books.append(book)
+    return books
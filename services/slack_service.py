@@ -1,9 +1,17 @@
 import os
 import requests
 import logging
-from functools import lru_cache
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from models import db, User
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from sqlalchemy import delete, func, insert, select, update
+
+from models import db, User, SlackUserCache
 
 logger = logging.getLogger(__name__)
 
@@ -12,22 +20,165 @@ SLACK_ENABLED = os.environ.get('SLACK_ENABLED', 'false').lower() in ['true', '1'
 
 SLACK_API_URL = 'https://slack.com/api/'
 
-@lru_cache(maxsize=128)
+# 接続・読み取りのタイムアウト（秒）
+SLACK_CONNECT_TIMEOUT = float(os.environ.get('SLACK_CONNECT_TIMEOUT') or 3)
+SLACK_READ_TIMEOUT = float(os.environ.get('SLACK_READ_TIMEOUT') or 10)
+
+# 429（レート制限）・502/503/504（POSTは429のみ）の再試行回数と、Retry-Afterがない場合の待ち時間の係数
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES') or 3)
+SLACK_RETRY_BACKOFF = float(os.environ.get('SLACK_RETRY_BACKOFF') or 0.5)
+
+# 保持しておくkeep-alive接続の数（同時に送信するスレッド数以上にする）
+SLACK_POOL_SIZE = int(os.environ.get('SLACK_POOL_SIZE') or 10)
+
+# 一括送信（send_slack_dms）で同時に送信するスレッド数
+SLACK_MAX_WORKERS = int(os.environ.get('SLACK_MAX_WORKERS') or 8)
+
+# メソッドごとの送信レート（回/秒）と瞬間的に許容する回数
+# chat.postMessage は特別枠（チャンネルごとに約1回/秒、全体でも数百回/分）、
+# users.lookupByEmail は Tier 3（約50回/分）
+SLACK_RATE_LIMITS = {
+    'chat.postMessage': (float(os.environ.get('SLACK_POST_MESSAGE_RATE') or 5), 10),
+    'users.lookupByEmail': (50 / 60, 5),
+    'users.list': (20 / 60, 3),  # Tier 2
+}
+
+# メールアドレス → SlackユーザーIDのキャッシュの有効期間（見つからなかった結果は短めに保持する）
+SLACK_USER_CACHE_TTL = timedelta(hours=int(os.environ.get('SLACK_USER_CACHE_TTL_HOURS') or 168))
+SLACK_USER_CACHE_MISS_TTL = timedelta(hours=1)
+
+# users.list の1ページの件数（Slackの推奨上限は200）
+SLACK_USERS_LIST_PAGE_SIZE = 200
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TokenBucket:
+    """トークンバケットによる送信レートの制限（スレッドセーフ）"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得する（足りない場合は補充されるまで待つ）"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiters = {method: TokenBucket(rate, capacity) for method, (rate, capacity) in SLACK_RATE_LIMITS.items()}
+
+
+class SlackRetry(Retry):
+    """
+    Slack API用の再試行ポリシー
+
+    POST（chat.postMessage）は冪等ではなく、502/503/504 の時点でSlack側では送信済みの
+    可能性があるため、処理されていないことが明らかな 429 のみ再試行する。
+    GET（users.lookupByEmail など）は 502/503/504 も再試行する。
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == 'POST' and status_code != 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def _get_session():
+    """
+    Slack API用の共有セッションを返す
+
+    接続をプールして使い回すことで、メッセージごとのTCP/TLSの接続確立を省く。
+    429・502/503/504の応答は Retry-After ヘッダーに従って待ってから再試行する
+    （POSTは 429 のみ。SlackRetry を参照）。接続できなかった場合は送信前のため常に再試行する。
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = SlackRetry(
+                    total=SLACK_MAX_RETRIES,
+                    connect=SLACK_MAX_RETRIES,
+                    read=0,  # 送信済みの可能性があるため読み取りエラーでは再試行しない
+                    status=SLACK_MAX_RETRIES,
+                    status_forcelist=(429, 502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'POST']),
+                    backoff_factor=SLACK_RETRY_BACKOFF,
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=SLACK_POOL_SIZE, pool_block=True, max_retries=retry
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Authorization'] = f'Bearer {SLACK_BOT_TOKEN}'
+                _session = session
+    return _session
+
+def _timeout():
+    return (SLACK_CONNECT_TIMEOUT, SLACK_READ_TIMEOUT)
+
+
+def _read_cached_slack_user_id(email):
+    """キャッシュからSlackユーザーIDを取得する（(見つかったか, ID) を返す）"""
+    with db.engine.connect() as connection:
+        row = connection.execute(
+            select(SlackUserCache.slack_user_id, SlackUserCache.fetched_at).where(SlackUserCache.email == email)
+        ).first()
+    if row is None:
+        return False, None
+    ttl = SLACK_USER_CACHE_TTL if row.slack_user_id else SLACK_USER_CACHE_MISS_TTL
+    if row.fetched_at < datetime.utcnow() - ttl:
+        return False, None
+    return True, row.slack_user_id
+
+def _write_cached_slack_user_id(email, slack_id):
+    """検索結果をキャッシュに保存する（呼び出し元のトランザクションとは別にコミットする）"""
+    with db.engine.begin() as connection:
+        connection.execute(delete(SlackUserCache).where(SlackUserCache.email == email))
+        connection.execute(insert(SlackUserCache).values(
+            email=email, slack_user_id=slack_id, fetched_at=datetime.utcnow()
+        ))
+
 def _get_slack_user_id(email):
-    """メールアドレスからSlackのユーザーIDを取得する（キャッシュ付き）"""
+    """メールアドレスからSlackのユーザーIDを取得する（slack_user_cache テーブルにキャッシュする）"""
+    email = email.strip().lower()
+    try:
+        cached, slack_id = _read_cached_slack_user_id(email)
+        if cached:
+            return slack_id
+    except Exception as e:
+        logger.error(f"Failed to read Slack user cache: {e}")
+
     if not SLACK_BOT_TOKEN:
         logger.error("SLACK_BOT_TOKEN is not set.")
         return None
     
-    headers = {'Authorization': f'Bearer {SLACK_BOT_TOKEN}'}
     params = {'email': email}
     
     try:
-        response = requests.get(f'{SLACK_API_URL}users.lookupByEmail', headers=headers, params=params)
+        _rate_limiters['users.lookupByEmail'].acquire()
+        response = _get_session().get(f'{SLACK_API_URL}users.lookupByEmail', params=params, timeout=_timeout())
         response.raise_for_status()
         data = response.json()
         if data.get('ok'):
-            return data['user']['id']
+            slack_id = data['user']['id']
+        elif data.get('error') == 'users_not_found':
+            slack_id = None
         else:
             logger.error(f"Slack API error (users.lookupByEmail): {data.get('error')}")
             return None
@@ -35,13 +186,96 @@ def _get_slack_user_id(email):
         logger.error(f"Failed to call Slack API (users.lookupByEmail): {e}")
         return None
 
+    try:
+        _write_cached_slack_user_id(email, slack_id)
+    except Exception as e:
+        logger.error(f"Failed to write Slack user cache: {e}")
+    return slack_id
+
+def _fetch_slack_directory():
+    """
+    users.list を最後のページまで取得し、メールアドレス → SlackユーザーIDの辞書を返す
+
+    削除済みのユーザーとボットは含めない。APIエラーの場合はNoneを返す。
+    """
+    directory = {}
+    cursor = None
+    while True:
+        params = {'limit': SLACK_USERS_LIST_PAGE_SIZE}
+        if cursor:
+            params['cursor'] = cursor
+        try:
+            _rate_limiters['users.list'].acquire()
+            response = _get_session().get(f'{SLACK_API_URL}users.list', params=params, timeout=_timeout())
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to call Slack API (users.list): {e}")
+            return None
+        if not data.get('ok'):
+            logger.error(f"Slack API error (users.list): {data.get('error')}")
+            return None
+
+        for member in data.get('members', []):
+            email = (member.get('profile') or {}).get('email')
+            if email and not member.get('deleted') and not member.get('is_bot'):
+                directory[email.strip().lower()] = member['id']
+
+        cursor = (data.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            return directory
+
+def sync_slack_user_ids():
+    """
+    Slackのユーザー一覧を取り込み、全ユーザーの slack_user_id をまとめて更新する
+
+    users.list の結果で slack_user_cache を作り直し、メールアドレスが一致するユーザーの
+    slack_user_id を1回のUPDATEで更新する。初めてDMを送るユーザーでも個別の検索が不要になる。
+
+    Returns:
+        tuple: (取り込んだSlackユーザー数, slack_user_id を更新したユーザー数)
+            APIエラーの場合は None
+    """
+    if not SLACK_BOT_TOKEN:
+        logger.error("SLACK_BOT_TOKEN is not set.")
+        return None
+
+    directory = _fetch_slack_directory()
+    if directory is None:
+        return None
+
+    now = datetime.utcnow()
+    db.session.execute(delete(SlackUserCache))
+    if directory:
+        db.session.execute(insert(SlackUserCache), [
+            {'email': email, 'slack_user_id': slack_id, 'fetched_at': now}
+            for email, slack_id in directory.items()
+        ])
+
+    users = User.__table__
+    cached_id = select(SlackUserCache.slack_user_id).where(
+        SlackUserCache.email == func.lower(users.c.email)
+    ).scalar_subquery()
+    result = db.session.execute(
+        update(users).where(
+            func.lower(users.c.email).in_(select(SlackUserCache.email)),
+            (users.c.slack_user_id.is_(None)) | (users.c.slack_user_id != cached_id)
+        ).values(
+            slack_user_id=cached_id,
+            updated_at=users.c.updated_at  # 連携情報の更新では更新日時を変えない
+        )
+    )
+    db.session.commit()
+
+    logger.info(f"Synced {len(directory)} Slack users, updated {result.rowcount} library users")
+    return len(directory), result.rowcount
+
 def _send_dm(user_id, message):
     """指定されたユーザーIDにDMを送信する"""
     if not SLACK_BOT_TOKEN:
         logger.error("SLACK_BOT_TOKEN is not set for sending DM.")
         return False
         
-    headers = {'Authorization': f'Bearer {SLACK_BOT_TOKEN}', 'Content-Type': 'application/json'}
     payload = {
         'channel': user_id,
         'text': message,
@@ -50,7 +284,8 @@ def _send_dm(user_id, message):
     }
     
     try:
-        response = requests.post(f'{SLACK_API_URL}chat.postMessage', headers=headers, json=payload)
+        _rate_limiters['chat.postMessage'].acquire()
+        response = _get_session().post(f'{SLACK_API_URL}chat.postMessage', json=payload, timeout=_timeout())
         response.raise_for_status()
         data = response.json()
         if data.get('ok'):
@@ -88,6 +323,49 @@ def send_slack_dm_to_user(user, message):
             
     return _send_dm(slack_id, message)
 
+def send_slack_dms(notifications, max_workers=None):
+    """
+    複数のDMを並行して送信する（スケジューラーでの一括送信用）
+
+    SlackユーザーIDの検索とDBへの保存は呼び出し元のスレッドでまとめて行い、
+    送信だけをスレッドプールで並行させる。送信レートはメソッドごとのトークンバケットで制限する。
+
+    Args:
+        notifications: (キー, ユーザー, メッセージ) のリスト
+        max_workers: 同時に送信するスレッド数（省略時は SLACK_MAX_WORKERS）
+
+    Returns:
+        set: 送信に成功した通知のキー
+    """
+    if not notifications:
+        return set()
+    if not SLACK_ENABLED:
+        for _, user, message in notifications:
+            logger.info(f"Slack notifications are disabled. Would have sent DM to {user.name}: {message}")
+        return {key for key, _, _ in notifications}
+
+    slack_ids = {}
+    found = False
+    for _, user, _ in notifications:
+        if user.id in slack_ids:
+            continue
+        if not user.slack_user_id:
+            slack_id = _get_slack_user_id(user.email)
+            if not slack_id:
+                logger.warning(f"Could not find Slack user ID for email: {user.email}")
+            else:
+                user.slack_user_id = slack_id
+                found = True
+        slack_ids[user.id] = user.slack_user_id
+
+    targets = [(key, slack_ids[user.id], message) for key, user, message in notifications if slack_ids[user.id]]
+    if found:
+        db.session.commit()
+
+    with ThreadPoolExecutor(max_workers=max_workers or SLACK_MAX_WORKERS) as executor:
+        results = list(executor.map(lambda target: _send_dm(target[1], target[2]), targets))
+    return {key for (key, _, _), success in zip(targets, results) if success}
+
 def send_error_notification(error_message):
     """システム管理者にエラー通知を送信する"""
     if not SLACK_ENABLED:
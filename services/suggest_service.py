@@ -0,0 +1,253 @@
+"""
+書籍検索の入力補完（サジェスト）を管理するサービス
+
+書籍のタイトル・著者名をソート済み配列のプレフィックスインデックスとして
+プロセス内に保持し、キー入力ごとにDBへ問い合わせずに候補を返す。
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Book
+from utils.tokenizer import normalize
+
+logger = logging.getLogger(__name__)
+
+# 他のプロセスでの変更を取り込むため、一定時間ごとに全件を読み直す
+REBUILD_INTERVAL_SECONDS = 600
+
+SUGGEST_FIELDS = ('title', 'author')
+
+
+class PrefixIndex:
+    """タイトル・著者名のプレフィックスインデックス（ソート済み配列 + 二分探索）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # 正規化した文字列（ソート済み）
+        self._entries = []  # _keys と同じ順序の (種類, 表示文字列)
+        self._counts = {}  # (種類, 表示文字列) -> 該当する書籍数
+        self._book_entries = {}  # book_id -> そのbookが持つ (種類, 表示文字列) の集合
+        self._built_at = None
+        self._building = False
+        self._pending = []  # 作り直しの最中に届いた変更（入れ替え後に適用する）
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    @property
+    def is_tracking(self):
+        """書籍の変更を反映する必要があるか（作成済みまたは作成中）"""
+        return self._built_at is not None or self._building
+
+    def build(self):
+        """
+        DBから全書籍のタイトル・著者名を読み込んでインデックスを作り直す
+
+        作り直している間も古いインデックスで候補を返す。同時に呼ばれた場合は
+        先に始まった1回だけを実行し、読み込み中に届いた変更は入れ替え後に適用する。
+
+        Returns:
+            bool: 作り直した場合はTrue（他の作り直しが実行中の場合はFalse）
+        """
+        with self._lock:
+            if self._building:
+                return False
+            self._building = True
+            self._pending = []
+        try:
+            rows = db.session.query(Book.id, Book.title, Book.author).all()
+            counts = {}
+            book_entries = {}
+            for book_id, title, author in rows:
+                entries = self._entries_for(title, author)
+                book_entries[book_id] = entries
+                for entry in entries:
+                    counts[entry] = counts.get(entry, 0) + 1
+            pairs = sorted((normalize(entry[1]), entry) for entry in counts)
+
+            with self._lock:
+                self._keys = [key for key, _ in pairs]
+                self._entries = [entry for _, entry in pairs]
+                self._counts = counts
+                self._book_entries = book_entries
+                for book_id, values in self._pending:
+                    self._apply(book_id, values)
+                self._built_at = time.monotonic()
+                size = len(self._keys)
+            logger.info(f"Built suggest index with {size} entries")
+            return True
+        finally:
+            with self._lock:
+                self._building = False
+                self._pending = []
+
+    @staticmethod
+    def _entries_for(title, author):
+        entries = set()
+        for kind, value in zip(SUGGEST_FIELDS, (title, author)):
+            if value and value.strip():
+                entries.add((kind, value.strip()))
+        return entries
+
+    def _insert(self, entry):
+        count = self._counts.get(entry, 0)
+        self._counts[entry] = count + 1
+        if count == 0:
+            key = normalize(entry[1])
+            position = bisect.bisect_left(self._keys, key)
+            self._keys.insert(position, key)
+            self._entries.insert(position, entry)
+
+    def _delete(self, entry):
+        count = self._counts.get(entry, 0)
+        if count > 1:
+            self._counts[entry] = count - 1
+            return
+        self._counts.pop(entry, None)
+        key = normalize(entry[1])
+        position = bisect.bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position] == key:
+            if self._entries[position] == entry:
+                del self._keys[position]
+                del self._entries[position]
+                return
+            position += 1
+
+    def _apply(self, book_id, values):
+        """書籍1件分のエントリを差し替える（values が None の場合は削除する。ロックを取得して呼ぶ）"""
+        old_entries = self._book_entries.pop(book_id, set())
+        new_entries = self._entries_for(*values) if values is not None else set()
+        for entry in old_entries - new_entries:
+            self._delete(entry)
+        for entry in new_entries - old_entries:
+            self._insert(entry)
+        if values is not None:
+            self._book_entries[book_id] = new_entries
+
+    def _change(self, book_id, values):
+        with self._lock:
+            if self._building:
+                self._pending.append((book_id, values))
+            if self.is_built:
+                self._apply(book_id, values)
+
+    def update(self, book_id, title, author):
+        """書籍1件分のエントリを差し替える"""
+        self._change(book_id, (title, author))
+
+    def remove(self, book_id):
+        """書籍1件分のエントリを削除する"""
+        self._change(book_id, None)
+
+    def suggest(self, prefix, limit=10):
+        """
+        前方一致する候補を返す
+
+        Args:
+            prefix: 入力中の文字列
+            limit: 返す最大件数
+
+        Returns:
+            list: {'text': 表示文字列, 'type': 'title' | 'author'} のリスト
+        """
+        key = normalize(prefix).strip()
+        if not key:
+            return []
+
+        results = []
+        with self._lock:
+            position = bisect.bisect_left(self._keys, key)
+            while position < len(self._keys) and len(results) < limit:
+                if not self._keys[position].startswith(key):
+                    break
+                kind, text = self._entries[position]
+                results.append({'text': text, 'type': kind})
+                position += 1
+        return results
+
+
+suggest_index = PrefixIndex()
+
+
+class SuggestIndexRefresher:
+    """インデックスを作成し、REBUILD_INTERVAL_SECONDS ごとに作り直すバックグラウンドスレッド"""
+
+    def __init__(self, index):
+        self.index = index
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self, app):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='suggest-index', daemon=True)
+            self._thread.start()
+
+    def _run(self, app):
+        while True:
+            with app.app_context():
+                try:
+                    self.index.build()
+                except Exception as e:
+                    logger.error(f"Failed to build suggest index: {e}")
+                finally:
+                    db.session.remove()
+            time.sleep(REBUILD_INTERVAL_SECONDS if self.index.is_built else 30)
+
+
+refresher = SuggestIndexRefresher(suggest_index)
+
+
+def init_suggest_index(app):
+    """
+    リクエストを処理するプロセスで、最初のリクエスト時にインデックスの作成を開始する
+
+    `flask db upgrade` などのCLIのプロセスでは作成しない。作成が終わるまでの間、候補は空になる。
+    """
+    if app.testing:
+        return
+
+    @app.before_request
+    def start_suggest_index():
+        refresher.start(app)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_book_changes(session, flush_context):
+    """フラッシュされた書籍の変更をコミット時の反映用に記録する"""
+    if not suggest_index.is_tracking:
+        return
+    changes = session.info.setdefault('suggest_changes', {})
+    for obj in session.new.union(session.dirty):
+        if isinstance(obj, Book) and obj.id is not None:
+            changes[obj.id] = (obj.title, obj.author)
+    for obj in session.deleted:
+        if isinstance(obj, Book) and obj.id is not None:
+            changes[obj.id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_book_changes(session):
+    """コミットされた書籍の変更をインデックスに反映する"""
+    changes = session.info.pop('suggest_changes', None)
+    if not changes:
+        return
+    for book_id, values in changes.items():
+        if values is None:
+            suggest_index.remove(book_id)
+        else:
+            suggest_index.update(book_id, *values)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_book_changes(session):
+    """ロールバックされた変更は反映しない"""
+    session.info.pop('suggest_changes', None)
@@ -1,9 +1,62 @@
 # services/user_service.py
-from models import db, User, Book, LoanHistory
+from models import db, User, Book, LoanHistory, refresh_user_counters
 import csv
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from argon2 import PasswordHasher
 from werkzeug.security import generate_password_hash
-import chardet
 from flask import current_app
+from utils.encoding import detect_encoding
+
+# CSVインポートで進捗を報告する間隔（行数）
+IMPORT_PROGRESS_INTERVAL = 100
+
+# この件数未満のパスワードはプロセスを起動せずにその場でハッシュ化する
+PARALLEL_HASH_THRESHOLD = 8
+
+_worker_hasher = None
+
+def _init_hash_worker(parameters):
+    """ハッシュ化用の子プロセスで、アプリと同じパラメーターのハッシャーを作る"""
+    global _worker_hasher
+    _worker_hasher = PasswordHasher(**parameters)
+
+def _hash_in_worker(password):
+    return _worker_hasher.hash(password)
+
+def hash_passwords(passwords):
+    """
+    複数のパスワードをArgon2でハッシュ化する
+
+    Argon2は意図的に重い処理のため、件数が多い場合はCPU数分のプロセスで並列に計算する。
+    Webプロセスではアウトボックスやメール送信などのスレッドが動いているため、
+    ロックを持ったまま複製される fork ではなく spawn で子プロセスを起動する。
+
+    Args:
+        passwords: 平文のパスワードのリスト
+
+    Returns:
+        list: ハッシュのリスト（passwords と同じ順序）
+    """
+    from models import ph
+    workers = min(os.cpu_count() or 1, len(passwords))
+    if workers <= 1 or len(passwords) < PARALLEL_HASH_THRESHOLD:
+        return [ph.hash(password) for password in passwords]
+
+    parameters = {
+        'time_cost': ph.time_cost,
+        'memory_cost': ph.memory_cost,
+        'parallelism': ph.parallelism,
+        'hash_len': ph.hash_len,
+        'salt_len': ph.salt_len,
+        'type': ph.type,
+    }
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_hash_worker, initargs=(parameters,)
+    ) as executor:
+        return list(executor.map(_hash_in_worker, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
 
 def get_users():
     """ユーザー一覧を取得する"""
@@ -58,24 +111,44 @@ def delete_user(user_id):
         return True
     return False
 
+def reconcile_user_counters():
+    """
+    全ユーザーの貸出中・予約待ち・延滞中の件数を貸出履歴・予約から集計し直す
+
+    延滞中の件数は時間の経過で変わるため、定期実行タスクからも呼び出す。
+
+    Returns:
+        int: 更新したユーザー数
+    """
+    count = refresh_user_counters(db.session.connection())
+    db.session.commit()
+    current_app.logger.info(f"Reconciled loan counters for {count} users")
+    return count
+
 def get_all_users():
     """全ユーザーを取得"""
     return User.query.all()
 
-def import_users_from_csv(file_path):
-    """CSVファイルからユーザーを一括インポート"""
+def import_users_from_csv(file_path, progress=None):
+    """
+    CSVファイルからユーザーを一括インポート
+
+    Args:
+        file_path: CSVファイルのパス
+        progress: 処理済みの行数を受け取る関数（IMPORT_PROGRESS_INTERVAL 行ごとに呼び出す）
+
+    Returns:
+        tuple: (登録件数, エラー件数, エラーメッセージのリスト)
+    """
     success_count = 0
     error_count = 0
     errors = []
     users_to_add = []
+    passwords = []
 
     try:
         # 文字コード判定
-        with open(file_path, 'rb') as f:
-            raw_data = f.read()
-            encoding = chardet.detect(raw_data)['encoding']
-            if not encoding:
-                encoding = 'utf-8' # デフォルト
+        encoding = detect_encoding(file_path)
 
         with open(file_path, 'r', encoding=encoding, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
@@ -92,9 +165,14 @@ def import_users_from_csv(file_path):
                 # ヘッダーが不正な場合はここで処理を中断するのが望ましい
                 return 0, error_count, errors
 
+            # 重複チェック用に既存のメールアドレスを一度に取得（大文字・小文字は区別しない）
+            existing_emails = {email.lower() for (email,) in db.session.query(User.email) if email}
+            imported_emails = set()
 
             for i, row in enumerate(reader):
                 line_num = i + 2 # ヘッダー行を考慮
+                if progress and i and i % IMPORT_PROGRESS_INTERVAL == 0:
+                    progress(i)
                 try:
                     # 必須フィールドのチェック
                     if not all(key in row and row[key] for key in required_headers):
@@ -104,16 +182,17 @@ def import_users_from_csv(file_path):
 
                     email = row['email'].strip()
                     # 重複チェック (データベース内)
-                    if User.query.filter_by(email=email).first():
+                    if email.lower() in existing_emails:
                         errors.append(f"行 {line_num}: メールアドレス '{email}' は既に使用されています")
                         error_count += 1
                         continue
 
                     # 重複チェック (今回のCSVファイル内)
-                    if any(u.email == email for u in users_to_add):
+                    if email.lower() in imported_emails:
                         errors.append(f"行 {line_num}: このCSVファイル内でメールアドレス '{email}' が重複しています")
                         error_count += 1
                         continue
+                    imported_emails.add(email.lower())
                     
                     # is_admin の解釈
                     is_admin_str = row.get('is_admin', 'false').lower().strip()
@@ -124,9 +203,9 @@ def import_users_from_csv(file_path):
                         email=email,
                         is_admin=is_admin
                     )
-                    # パスワードをセット
-                    user.set_password(row['password'].strip())
+                    # パスワードはエラーがないことを確認してからまとめてハッシュ化する
                     users_to_add.append(user)
+                    passwords.append(row['password'].strip())
 
                 except Exception as e:
                     db.session.rollback()
@@ -138,8 +217,10 @@ def import_users_from_csv(file_path):
                 errors.insert(0, "ファイル内にエラーが検出されたため、インポート処理を中断しました。")
                 return 0, error_count, errors
 
-            # エラーがなければ、一括で追加とコミット
+            # エラーがなければ、パスワードを並列でハッシュ化して一括で追加とコミット
             if users_to_add:
+                for user, password_hash in zip(users_to_add, hash_passwords(passwords)):
+                    user.password_hash = password_hash
                 db.session.add_all(users_to_add)
                 db.session.commit()
                 success_count = len(users_to_add)
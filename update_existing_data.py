@@ -8,6 +8,7 @@
 from datetime import datetime
 from app import create_app
 from models import db, Book, CategoryLocationMapping
+from services.book_service import reserve_book_numbers
 
 def update_existing_books():
     """既存の書籍に管理番号を付与"""
@@ -23,26 +24,15 @@ def update_existing_books():
         # 現在の年を取得
         current_year = datetime.now().year
         
-        # 既存の管理番号から最新の連番を取得
-        latest_book = Book.query.filter(
-            Book.book_number.like(f'BO-{current_year}-%')
-        ).order_by(Book.book_number.desc()).first()
+        # 付与する件数分の管理番号をまとめて確保
+        book_numbers = reserve_book_numbers(len(books_without_number), current_year)
         
-        if latest_book:
-            # 既存の番号から連番を抽出
-            last_number = int(latest_book.book_number.split('-')[-1])
-            next_number = last_number + 1
-        else:
-            # 今年の最初の番号
-            next_number = 1
-        
-        print(f"管理番号の付与を開始します。開始番号: BO-{current_year}-{next_number:03d}")
+        print(f"管理番号の付与を開始します。開始番号: {book_numbers[0]}")
         
         # 書籍に管理番号を付与
-        for book in books_without_number:
-            book.book_number = f"BO-{current_year}-{next_number:03d}"
+        for book, book_number in zip(books_without_number, book_numbers):
+            book.book_number = book_number
             book.registration_date = datetime.now()  # 今日の日付を設定
-            next_number += 1
             print(f"書籍「{book.title}」に管理番号 {book.book_number} を付与")
         
         try:
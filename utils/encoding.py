@@ -0,0 +1,47 @@
+# utils/encoding.py
+"""
+アップロードされたファイルの文字コード判定
+"""
+
+from chardet.universaldetector import UniversalDetector
+
+# 文字コードの判定に読み込む最大バイト数
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+
+def detect_encoding(file_path, sample_bytes=ENCODING_SAMPLE_BYTES, default='utf-8'):
+    """
+    ファイルの先頭部分だけを読んで文字コードを判定する
+
+    判定が確定した時点で読み込みを打ち切るため、大きなファイルでも全体をメモリに読み込まない。
+
+    Args:
+        file_path: 判定するファイルのパス
+        sample_bytes: 読み込む最大バイト数
+        default: 判定できなかった場合の文字コード
+
+    Returns:
+        str: open() に渡せる文字コード名
+    """
+    detector = UniversalDetector()
+    with open(file_path, 'rb') as f:
+        read = 0
+        while read < sample_bytes and not detector.done:
+            chunk = f.read(min(4096, sample_bytes - read))
+            if not chunk:
+                break
+            detector.feed(chunk)
+            read += len(chunk)
+    detector.close()
+
+    encoding = detector.result.get('encoding')
+    if not encoding:
+        return default
+    encoding = encoding.lower()
+    # Shift_JISと判定されても機種依存文字を含むことが多いため、上位互換のCP932で読む
+    if encoding in ('shift_jis', 'sjis'):
+        return 'cp932'
+    # 先頭がASCIIだけでも、後ろに日本語を含むUTF-8のことがある
+    if encoding == 'ascii':
+        return default
+    return encoding
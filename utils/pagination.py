@@ -0,0 +1,91 @@
+# utils/pagination.py
+"""
+一覧画面のページネーション補助
+
+Flask-SQLAlchemy の paginate（OFFSET方式）に加えて、深いページでも読み込む行数が
+一定になるキーセット（シーク）方式のページネーションを提供する。
+"""
+
+import base64
+import json
+
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(values):
+    """並び替えキーの値をURLに載せられるカーソル文字列に変換する"""
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """カーソル文字列を並び替えキーの値に戻す（不正な場合はNone）"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def _after(columns, values):
+    """(c1, c2, ...) > (v1, v2, ...) を展開した条件を作る"""
+    conditions = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equals = [c == v for c, v in zip(columns[:i], values[:i])]
+        conditions.append(and_(*equals, column > value))
+    return or_(*conditions)
+
+
+class SimplePage:
+    """件数を数えないページ情報（次ページの有無だけを判定する）"""
+
+    def __init__(self, items, per_page, page=1, has_next=False, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.page = page
+        self.has_next = has_next
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+def keyset_paginate(query, columns, cursor, per_page):
+    """
+    キーセット方式でページを取得する
+
+    Args:
+        query: 絞り込み済みのクエリ（order_by は指定しない）
+        columns: 並び替えキーの列（最後の列は一意であること）
+        cursor: 前のページの encode_cursor() の値（先頭ページはNone）
+        per_page: 1ページの件数
+
+    Returns:
+        SimplePage: 取得したページ（next_cursor で次ページを取得できる）
+    """
+    values = decode_cursor(cursor, len(columns))
+    if values is not None:
+        query = query.filter(_after(columns, values))
+
+    rows = query.order_by(*columns).limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    items = rows[:per_page]
+
+    next_cursor = None
+    if has_next:
+        next_cursor = encode_cursor(getattr(items[-1], column.key) for column in columns)
+    return SimplePage(items, per_page, has_next=has_next, next_cursor=next_cursor)
@@ -0,0 +1,189 @@
+# utils/sql_profiler.py
+"""
+リクエスト単位のSQLプロファイラーとクエリ数の上限チェック
+
+SQL_PROFILER_ENABLED が有効な場合、リクエストごとに発行したSQLの件数・合計時間・
+遅いSQLの上位を記録し、レスポンスヘッダー（X-SQL-Query-Count, X-SQL-Time-Ms）と
+デバッグパネル（SQL_PROFILER_PANEL）で確認できるようにする。
+"""
+
+import heapq
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlsplit
+
+from flask import current_app, g, has_request_context, request
+from markupsafe import escape
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_listeners_installed = False
+
+
+class QueryProfile:
+    """1リクエスト（またはブロック）で発行されたSQLの統計"""
+
+    def __init__(self, slowest_limit=5):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_limit = slowest_limit
+        self._slowest = []  # (所要時間, 連番, SQL) のヒープ
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        item = (duration, self.count, statement)
+        if len(self._slowest) < self.slowest_limit:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    @property
+    def slowest(self):
+        """遅い順の (所要時間, SQL) のリスト"""
+        return [(duration, statement) for duration, _, statement in sorted(self._slowest, reverse=True)]
+
+
+# with query_counter(): ブロック内で有効なプロファイル（テスト用）
+_active_counters = []
+
+
+def _on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_profiler_start', []).append(time.perf_counter())
+
+
+def _on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('sql_profiler_start')
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+
+    for profile in _active_counters:
+        profile.record(statement, duration)
+
+    if has_request_context():
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.record(statement, duration)
+
+
+def _install_listeners():
+    global _listeners_installed
+    if _listeners_installed:
+        return
+    event.listen(Engine, 'before_cursor_execute', _on_before_execute)
+    event.listen(Engine, 'after_cursor_execute', _on_after_execute)
+    _listeners_installed = True
+
+
+@contextmanager
+def query_counter(slowest_limit=5):
+    """
+    ブロック内で発行されたSQLを記録する
+
+    使用例:
+        with query_counter() as profile:
+            client.get('/')
+        assert profile.count <= 10
+    """
+    _install_listeners()
+    profile = QueryProfile(slowest_limit)
+    _active_counters.append(profile)
+    try:
+        yield profile
+    finally:
+        _active_counters.remove(profile)
+
+
+def query_budget(max_queries):
+    """
+    ビューが発行してよいSQLの上限を宣言するデコレーター
+
+    プロファイラー有効時は上限を超えると警告ログを出力し、
+    テストでは assert_query_budget() で上限を検証できる。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            return f(*args, **kwargs)
+        decorated_function.query_budget = max_queries
+        return decorated_function
+    return decorator
+
+
+def assert_query_budget(client, path, method='GET', **kwargs):
+    """
+    テスト用: ルートを呼び出し、宣言されたクエリ数の上限を超えていないか検証する
+
+    Args:
+        client: app.test_client()
+        path: リクエストするパス
+        method: HTTPメソッド
+        **kwargs: client.open() に渡す追加の引数
+
+    Returns:
+        tuple: (レスポンス, QueryProfile)
+    """
+    app = client.application
+    endpoint, _ = app.url_map.bind('localhost').match(urlsplit(path).path, method=method)
+    budget = getattr(app.view_functions[endpoint], 'query_budget', None)
+    if budget is None:
+        raise AssertionError(f'{endpoint} にクエリ数の上限が宣言されていません')
+
+    with query_counter() as profile:
+        response = client.open(path, method=method, **kwargs)
+
+    if profile.count > budget:
+        statements = '\n'.join(f'  {duration * 1000:.1f}ms {statement}' for duration, statement in profile.slowest)
+        raise AssertionError(
+            f'{endpoint} のSQL発行数 {profile.count} が上限 {budget} を超えました\n{statements}'
+        )
+    return response, profile
+
+
+def _render_panel(profile):
+    rows = ''.join(
+        f'<tr><td class="text-end">{duration * 1000:.1f}ms</td><td><code>{escape(statement)}</code></td></tr>'
+        for duration, statement in profile.slowest
+    )
+    return (
+        '<div id="sql-profiler-panel" class="container my-3"><div class="card border-secondary">'
+        f'<div class="card-header">SQL: {profile.count}件 / {profile.total_time * 1000:.1f}ms</div>'
+        f'<div class="card-body p-0"><table class="table table-sm mb-0">{rows}</table></div>'
+        '</div></div>'
+    )
+
+
+def init_sql_profiler(app):
+    """アプリケーションにSQLプロファイラーを登録する"""
+    if not app.config.get('SQL_PROFILER_ENABLED'):
+        return
+    _install_listeners()
+
+    @app.before_request
+    def start_sql_profile():
+        g.sql_profile = QueryProfile(app.config.get('SQL_PROFILER_SLOWEST', 5))
+
+    @app.after_request
+    def finish_sql_profile(response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+
+        response.headers['X-SQL-Query-Count'] = str(profile.count)
+        response.headers['X-SQL-Time-Ms'] = f'{profile.total_time * 1000:.1f}'
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and profile.count > budget:
+            current_app.logger.warning(
+                f'Query budget exceeded on {request.endpoint}: {profile.count} > {budget}'
+            )
+
+        if (app.config.get('SQL_PROFILER_PANEL') and response.mimetype == 'text/html'
+                and not response.direct_passthrough):
+            body = response.get_data(as_text=True)
+            if '</body>' in body:
+                response.set_data(body.replace('</body>', _render_panel(profile) + '</body>', 1))
+        return response
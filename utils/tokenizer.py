@@ -0,0 +1,70 @@
+# utils/tokenizer.py
+"""
+書籍検索用の日本語n-gramトークナイザー
+
+全角・半角の揺れ（NFKC正規化）とカタカナ・ひらがなの違いを吸収した上で、
+文字単位のバイグラム・トライグラムに分割する。
+"""
+
+import re
+import unicodedata
+
+# トークン化に使うn-gramの長さ
+NGRAM_SIZES = (2, 3)
+
+# 空白や記号で文字列を区切る
+_SEPARATOR_RE = re.compile(r'[\s　、。・,.;:!?！？「」『』（）()\[\]【】/\\\-_+&"\'#*|~]+')
+
+# カタカナ（ァ〜ヶ）をひらがなへ変換する差分
+_KATAKANA_START = 0x30A1
+_KATAKANA_END = 0x30F6
+_KANA_OFFSET = 0x60
+
+
+def normalize(text):
+    """
+    検索用に文字列を正規化する
+
+    - NFKCで全角英数字を半角に、半角カナを全角に揃える
+    - 英字を小文字に揃える
+    - カタカナをひらがなに揃える
+    """
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(
+        chr(ord(ch) - _KANA_OFFSET) if _KATAKANA_START <= ord(ch) <= _KATAKANA_END else ch
+        for ch in text
+    )
+
+
+def split_segments(text):
+    """正規化済みの文字列を空白・記号で区切る"""
+    return [segment for segment in _SEPARATOR_RE.split(text) if segment]
+
+
+def tokenize(text, sizes=NGRAM_SIZES):
+    """
+    文字列をn-gramトークンのリストに分割する（出現回数を数えるため重複を残す）
+
+    Args:
+        text: 対象の文字列
+        sizes: 生成するn-gramの長さ
+
+    Returns:
+        list: トークンのリスト
+    """
+    tokens = []
+    for segment in split_segments(normalize(text)):
+        if len(segment) < min(sizes):
+            # n-gramに満たない短い語はそのまま1トークンとする
+            tokens.append(segment)
+            continue
+        for n in sizes:
+            tokens.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return tokens
+
+
+def query_terms(text, sizes=NGRAM_SIZES):
+    """検索クエリを重複のないトークンのリストに変換する（出現順を保持）"""
+    return list(dict.fromkeys(tokenize(text, sizes)))